@@ -0,0 +1,301 @@
+"""In-process caches and cross-process invalidation.
+
+Each worker keeps its own LRU caches. When a worker writes, it updates its own
+cache in place and publishes an invalidation event ``(kind, key)`` so other
+workers drop their copy: ``("state", client_id)`` or ``("catalog", version)``.
+
+Bus implementations, selected by CACHE_INVALIDATION:
+
+- ``local``: single process only; nothing to notify. Must be chosen
+  explicitly: a process cannot tell whether it is one of several workers
+  (``uvicorn --workers`` does not set WEB_CONCURRENCY).
+- ``poll`` (default): each event is a small document in the capped collection
+  ``cache_invalidation_log``, numbered from a counter in ``cache_versions``;
+  workers poll for numbers above the last one they saw. Works on a standalone
+  mongod.
+- ``changestream``: events are inserted into ``cache_invalidations`` and
+  delivered through a change stream. Requires a replica set.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import CollectionInvalid
+
+from database import retry_with_backoff
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[str, str], Awaitable[None]]
+
+VERSION_DOC_ID = "invalidations"
+EVENT_LOG = "cache_invalidation_log"
+# number of recent events kept in the capped event log
+EVENT_WINDOW = 1000
+# how long a poller waits for a missing sequence number before giving up on it
+GAP_TIMEOUT = 2.0
+# an event kind that tells subscribers to drop everything (missed events)
+FLUSH_ALL = "*"
+
+
+class LRUCache:
+    """A bounded mapping with least-recently-used eviction and optional TTL.
+
+    Readers that load a value asynchronously call ``begin_fill`` before the
+    load and ``fill`` after it; the fill is dropped if the key was written or
+    invalidated in between, so a slow read never replaces a newer value.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        # key -> ticket of the latest read started since the key last changed
+        self._fills: Dict[Hashable, object] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Any:
+        entry = self._data.get(key)
+        if entry is None or (self.ttl and time.monotonic() - entry[1] > self.ttl):
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key: Hashable, value: Any):
+        self._fills.pop(key, None)
+        self._store(key, value)
+
+    def _store(self, key: Hashable, value: Any):
+        self._data[key] = (value, time.monotonic())
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def begin_fill(self, key: Hashable) -> object:
+        if len(self._fills) >= self.maxsize:
+            # abandoned reads (errors); their fills are simply skipped
+            self._fills.clear()
+        ticket = self._fills[key] = object()
+        return ticket
+
+    def fill(self, key: Hashable, value: Any, ticket: object) -> bool:
+        """Store ``value`` unless ``key`` changed since ``begin_fill`` returned ``ticket``."""
+        if self._fills.get(key) is not ticket:
+            return False
+        del self._fills[key]
+        self._store(key, value)
+        return True
+
+    def pop(self, key: Hashable):
+        self._fills.pop(key, None)
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._fills.clear()
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class InvalidationBus:
+    """Base bus: subscribers receive events published by *other* processes."""
+
+    mode = "base"
+
+    def __init__(self):
+        self.origin = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._handlers: List[Handler] = []
+
+    def subscribe(self, handler: Handler):
+        self._handlers.append(handler)
+
+    async def publish(self, kind: str, key: str):
+        raise NotImplementedError
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def dispatch(self, kind: str, key: str):
+        for handler in self._handlers:
+            try:
+                await handler(kind, key)
+            except Exception:
+                logger.exception("Cache invalidation handler failed for %s:%s", kind, key)
+
+
+class LocalBus(InvalidationBus):
+    """Single-process bus; the writer already updated the only cache there is."""
+
+    mode = "local"
+
+    async def publish(self, kind: str, key: str):
+        pass
+
+
+class _BackgroundBus(InvalidationBus):
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        # no I/O here: startup must not wait for Mongo
+        self._task = asyncio.create_task(self._main())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _main(self):
+        await retry_with_backoff(self._prepare, "Preparing cache invalidation")
+        # events published before we were listening are lost; drop anything
+        # cached in the meantime
+        await self.dispatch(FLUSH_ALL, "")
+        await self._run()
+
+    async def _prepare(self):
+        pass
+
+    async def _run(self):
+        raise NotImplementedError
+
+
+class PollingBus(_BackgroundBus):
+    """Polls a capped event log for sequence numbers above the last one seen.
+
+    Sequence numbers come from an ``$inc`` on a counter document, so they are
+    assigned in order but may become visible out of order. A poller only
+    advances over a contiguous run; a hole that does not fill within
+    GAP_TIMEOUT (the publisher died, or the events were rotated out of the
+    log) is skipped with a FLUSH_ALL.
+    """
+
+    mode = "poll"
+
+    def __init__(self, db, interval: float = 0.5):
+        super().__init__(db)
+        self.interval = interval
+        self.seq = 0
+        self._gap_since: Optional[float] = None
+
+    async def publish(self, kind: str, key: str):
+        counter = await self.db.cache_versions.find_one_and_update(
+            {"_id": VERSION_DOC_ID},
+            {"$inc": {"seq": 1}},
+            projection={"seq": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        await self.db[EVENT_LOG].insert_one(
+            {"seq": counter["seq"], "kind": kind, "key": key, "origin": self.origin, "at": datetime.utcnow()}
+        )
+
+    async def _prepare(self):
+        try:
+            # bounded by count and by size (generous for small event documents)
+            await self.db.create_collection(EVENT_LOG, capped=True, size=EVENT_WINDOW * 1024, max=EVENT_WINDOW)
+        except CollectionInvalid:
+            pass  # already exists
+        await self.db[EVENT_LOG].create_index("seq")
+        doc = await self.db.cache_versions.find_one({"_id": VERSION_DOC_ID}, {"seq": 1})
+        self.seq = (doc or {}).get("seq", 0)
+
+    async def poll_once(self):
+        events = await self.db[EVENT_LOG].find({"seq": {"$gt": self.seq}}, {"_id": 0}).sort("seq", 1).to_list(EVENT_WINDOW)
+        for ev in events:
+            if ev["seq"] != self.seq + 1:
+                break
+            self.seq = ev["seq"]
+            if ev.get("origin") != self.origin:
+                await self.dispatch(ev["kind"], ev["key"])
+        else:
+            self._gap_since = None
+            return
+        now = time.monotonic()
+        if self._gap_since is None:
+            self._gap_since = now
+        elif now - self._gap_since >= GAP_TIMEOUT:
+            logger.warning("Cache invalidation %d never arrived; flushing caches", self.seq + 1)
+            self.seq = events[-1]["seq"]
+            self._gap_since = None
+            await self.dispatch(FLUSH_ALL, "")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.poll_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Polling cache invalidations failed")
+
+
+class ChangeStreamBus(_BackgroundBus):
+    """Delivers events through a change stream on ``cache_invalidations``."""
+
+    mode = "changestream"
+
+    async def publish(self, kind: str, key: str):
+        await self.db.cache_invalidations.insert_one(
+            {"kind": kind, "key": key, "origin": self.origin, "at": datetime.utcnow()}
+        )
+
+    async def _prepare(self):
+        await self.db.cache_invalidations.create_index("at", expireAfterSeconds=3600)
+
+    async def _run(self):
+        pipeline = [{"$match": {"operationType": "insert", "fullDocument.origin": {"$ne": self.origin}}}]
+        while True:
+            try:
+                async with self.db.cache_invalidations.watch(pipeline) as stream:
+                    async for change in stream:
+                        ev = change["fullDocument"]
+                        await self.dispatch(ev["kind"], ev["key"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Cache invalidation change stream failed; reconnecting")
+                # events may have been missed while disconnected
+                await self.dispatch(FLUSH_ALL, "")
+                await asyncio.sleep(1)
+
+
+def invalidation_mode() -> str:
+    return os.environ.get("CACHE_INVALIDATION") or "poll"
+
+
+def create_bus(db, mode: Optional[str] = None) -> InvalidationBus:
+    mode = mode or invalidation_mode()
+    if mode == "local":
+        return LocalBus()
+    if mode == "poll":
+        return PollingBus(db, interval=int(os.environ.get("CACHE_INVALIDATION_POLL_MS", "500")) / 1000)
+    if mode == "changestream":
+        return ChangeStreamBus(db)
+    raise ValueError(f"Unknown CACHE_INVALIDATION mode: {mode}")
+
+
+def cache_stats(cache: LRUCache) -> Dict[str, Any]:
+    return {"size": len(cache), "maxsize": cache.maxsize, "hits": cache.hits, "misses": cache.misses}
@@ -0,0 +1,117 @@
+"""Branch catalog loaded from a data file, with diff-based seeding.
+
+The catalog lives in ``data/branches.json`` as ``{"version": N, "branches": [...]}``.
+Each branch is tracked in Mongo by a content hash, so syncing only rewrites
+branches whose content changed and removes ones dropped from the file. The
+last synced version is kept in ``catalog_meta``; an older file never
+overwrites a newer catalog written by another instance.
+"""
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from pymongo import DeleteMany, ReplaceOne
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+CATALOG_PATH = Path(os.environ.get("CATALOG_PATH", Path(__file__).parent / "data" / "branches.json"))
+META_ID = "branches"
+
+
+def content_hash(branch: Dict[str, Any]) -> str:
+    raw = json.dumps(branch, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class Catalog:
+    """An immutable snapshot of the catalog plus the indexes derived from it.
+
+    ``parse`` turns a raw branch dict into the object served by the API; it
+    runs once per load so requests never re-validate catalog data.
+    """
+
+    def __init__(self, version: int, branches: List[Dict[str, Any]], parse: Optional[Callable[[Dict[str, Any]], Any]] = None):
+        self.version = version
+        self.branches = branches
+        self.hashes = {b["slug"]: content_hash(b) for b in branches}
+        self.hash = content_hash(self.hashes)
+        self.items = [parse(b) if parse else b for b in branches]
+        self.by_slug = {b["slug"]: item for b, item in zip(branches, self.items)}
+        if len(self.by_slug) != len(branches):
+            raise ValueError("Duplicate branch slug in catalog")
+
+    def __contains__(self, slug: str) -> bool:
+        return slug in self.by_slug
+
+
+def load_catalog(path: Path = CATALOG_PATH, parse: Optional[Callable[[Dict[str, Any]], Any]] = None) -> Catalog:
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return Catalog(int(data["version"]), data["branches"], parse)
+
+
+async def load_catalog_from_db(db, parse: Optional[Callable[[Dict[str, Any]], Any]] = None) -> Optional[Catalog]:
+    """Rebuild the catalog from what another instance synced into Mongo."""
+    meta = await db.catalog_meta.find_one({"_id": META_ID})
+    if not meta:
+        return None
+    docs = await db.branches.find({}, {"_id": 0, "content_hash": 0, "catalog_version": 0}).sort("position", 1).to_list(None)
+    for d in docs:
+        d.pop("position", None)
+    return Catalog(meta["version"], docs, parse)
+
+
+async def ensure_catalog_indexes(db):
+    await db.branches.create_index("slug", unique=True)
+
+
+async def sync_catalog(db, catalog: Catalog) -> Dict[str, Any]:
+    """Upsert changed branches and delete removed ones; returns what changed.
+
+    The version is claimed in ``catalog_meta`` with a conditional update
+    first, so an instance holding an older file never gets to write branches
+    once a newer version has been recorded.
+    """
+    try:
+        await db.catalog_meta.update_one(
+            {"_id": META_ID, "version": {"$lte": catalog.version}},
+            {"$set": {"version": catalog.version, "hash": catalog.hash, "updated_at": datetime.utcnow()}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        # the filter did not match an existing document: it holds a newer version
+        meta = await db.catalog_meta.find_one({"_id": META_ID}) or {}
+        logger.warning(
+            "Catalog version %s in database is newer than %s; not syncing", meta.get("version"), catalog.version
+        )
+        return {"version": meta.get("version"), "upserted": [], "removed": [], "skipped": True}
+
+    existing = {
+        d["slug"]: d
+        async for d in db.branches.find({}, {"_id": 0, "slug": 1, "content_hash": 1, "position": 1})
+    }
+    ops = []
+    upserted = []
+    for position, branch in enumerate(catalog.branches):
+        slug = branch["slug"]
+        h = catalog.hashes[slug]
+        old = existing.get(slug)
+        if old and old.get("content_hash") == h and old.get("position") == position:
+            continue
+        doc = {**branch, "content_hash": h, "catalog_version": catalog.version, "position": position}
+        ops.append(ReplaceOne({"slug": slug}, doc, upsert=True))
+        upserted.append(slug)
+    removed = sorted(set(existing) - set(catalog.hashes))
+    if removed:
+        ops.append(DeleteMany({"slug": {"$in": removed}}))
+    if ops:
+        await db.branches.bulk_write(ops, ordered=False)
+        logger.info(
+            "Synced catalog v%s: %d branches upserted, %d removed", catalog.version, len(upserted), len(removed)
+        )
+    return {"version": catalog.version, "upserted": upserted, "removed": removed, "skipped": False}
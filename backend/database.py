@@ -0,0 +1,223 @@
+"""Lazily created, configurable Mongo client.
+
+Nothing here runs at import time: the client is built on first use, so the
+server module can be imported (and the app constructed) without MONGO_URL
+being set or Mongo being reachable.
+
+Connection settings (all optional; unset means the driver default):
+
+    MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, MONGO_MAX_IDLE_TIME_MS,
+    MONGO_MAX_CONNECTING, MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    MONGO_SERVER_SELECTION_TIMEOUT_MS, MONGO_CONNECT_TIMEOUT_MS,
+    MONGO_SOCKET_TIMEOUT_MS, MONGO_TIMEOUT_MS (client-wide operation timeout),
+    MONGO_COMPRESSORS (e.g. "zstd,zlib"), MONGO_ZLIB_LEVEL,
+    MONGO_READ_TIMEOUT_MS / MONGO_WRITE_TIMEOUT_MS (per-operation, see
+    operation_timeout), MONGO_CATALOG_READ_PREFERENCE (e.g. "secondaryPreferred").
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from contextlib import nullcontext
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, Type, TypeVar
+
+import pymongo
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo import monitoring
+from pymongo.errors import OperationFailure
+from pymongo.read_preferences import read_pref_mode_from_name, make_read_preference
+
+from profiling import mongo_tracer
+
+logger = logging.getLogger(__name__)
+
+_client: Optional[AsyncIOMotorClient] = None
+
+T = TypeVar("T")
+
+# env var -> MongoClient keyword, all integers
+_INT_OPTIONS = {
+    "MONGO_MAX_POOL_SIZE": "maxPoolSize",
+    "MONGO_MIN_POOL_SIZE": "minPoolSize",
+    "MONGO_MAX_IDLE_TIME_MS": "maxIdleTimeMS",
+    "MONGO_MAX_CONNECTING": "maxConnecting",
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": "waitQueueTimeoutMS",
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": "serverSelectionTimeoutMS",
+    "MONGO_CONNECT_TIMEOUT_MS": "connectTimeoutMS",
+    "MONGO_SOCKET_TIMEOUT_MS": "socketTimeoutMS",
+    "MONGO_TIMEOUT_MS": "timeoutMS",
+    "MONGO_ZLIB_LEVEL": "zlibCompressionLevel",
+}
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Counts pool checkouts and measures how long each one waited.
+
+    Listener callbacks run on the driver's executor threads; the checkout
+    start time is kept per thread since a checkout completes on the thread
+    that started it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.checkout_failures: Dict[str, int] = {}
+            self.checked_in = 0
+            self.connections_created = 0
+            self.connections_closed = 0
+            self.pools_cleared = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "checkout_failures": dict(self.checkout_failures),
+                "in_use": self.checkouts - self.checked_in,
+                "connections_open": self.connections_created - self.connections_closed,
+                "connections_created": self.connections_created,
+                "pools_cleared": self.pools_cleared,
+                "wait_ms_avg": (self.wait_total / self.checkouts * 1000) if self.checkouts else 0.0,
+                "wait_ms_max": self.wait_max * 1000,
+            }
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        started = getattr(self._local, "started", None)
+        waited = time.perf_counter() - started if started is not None else 0.0
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures[event.reason] = self.checkout_failures.get(event.reason, 0) + 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_in += 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.connections_created += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.connections_closed += 1
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pools_cleared += 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+
+pool_metrics = PoolMetrics()
+
+
+def client_options() -> Dict[str, Any]:
+    opts: Dict[str, Any] = {}
+    for env, key in _INT_OPTIONS.items():
+        value = os.environ.get(env)
+        if value:
+            opts[key] = int(value)
+    compressors = os.environ.get("MONGO_COMPRESSORS")
+    if compressors:
+        opts["compressors"] = compressors
+    return opts
+
+
+def get_client() -> AsyncIOMotorClient:
+    global _client
+    if _client is None:
+        _client = AsyncIOMotorClient(os.environ["MONGO_URL"], event_listeners=[pool_metrics, mongo_tracer], **client_options())
+    return _client
+
+
+def get_db() -> AsyncIOMotorDatabase:
+    return get_client()[os.environ["DB_NAME"]]
+
+
+def get_catalog_db() -> AsyncIOMotorDatabase:
+    """Database handle for catalog reads, which may be served by secondaries."""
+    mode = os.environ.get("MONGO_CATALOG_READ_PREFERENCE", "primary")
+    pref = make_read_preference(read_pref_mode_from_name(mode), None)
+    return get_client().get_database(os.environ["DB_NAME"], read_preference=pref)
+
+
+def _timeout_ms(env: str) -> Optional[float]:
+    value = os.environ.get(env)
+    return int(value) / 1000 if value else None
+
+
+def operation_timeout(kind: str):
+    """Context manager bounding the Mongo operations inside it ("read" or "write").
+
+    Uses pymongo's contextvar-based timeout, which Motor carries over to its
+    executor threads.
+    """
+    seconds = _timeout_ms("MONGO_READ_TIMEOUT_MS" if kind == "read" else "MONGO_WRITE_TIMEOUT_MS")
+    return pymongo.timeout(seconds) if seconds else nullcontext()
+
+
+async def ensure_ttl_index(collection, field: str, seconds: int, name: Optional[str] = None, **kwargs):
+    """Create a TTL index, or update its expiry if it exists with another one."""
+    name = name or f"{field}_1"
+    try:
+        await collection.create_index(field, name=name, expireAfterSeconds=seconds, **kwargs)
+    except OperationFailure as exc:
+        if exc.code != 85:  # IndexOptionsConflict
+            raise
+        await collection.database.command(
+            "collMod", collection.name, index={"name": name, "expireAfterSeconds": seconds}
+        )
+
+
+async def retry_with_backoff(
+    attempt_once: Callable[[], Awaitable[T]],
+    what: str,
+    retry_on: Tuple[Type[BaseException], ...] = (Exception,),
+    max_delay: int = 30,
+) -> T:
+    """Await ``attempt_once()`` until it succeeds, backing off exponentially between failures.
+
+    For startup work that must eventually succeed once Mongo is reachable.
+    """
+    attempt = 0
+    while True:
+        try:
+            return await attempt_once()
+        except asyncio.CancelledError:
+            raise
+        except retry_on:
+            attempt += 1
+            delay = min(2 ** attempt, max_delay)
+            logger.exception("%s failed (attempt %d); retrying in %ds", what, attempt, delay)
+            await asyncio.sleep(delay)
+
+
+def close_client():
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
@@ -0,0 +1,201 @@
+"""Client state lifecycle: last_seen tracking, archival and rehydration.
+
+Every visitor gets a ``client_states`` document, so the hot collection would
+otherwise grow with every client ever seen. Inactive documents are moved into
+``client_states_archive`` as zlib-compressed BSON and restored transparently
+the next time their client_id is requested. States that were created but never
+modified carry a ``pristine`` flag and are expired by a partial TTL index.
+"""
+import asyncio
+import logging
+import os
+import socket
+import uuid
+import zlib
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from bson import BSON, Binary
+from pymongo import ReplaceOne
+from pymongo.errors import DuplicateKeyError
+
+from database import ensure_ttl_index
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_COLLECTION = "client_states_archive"
+
+# Inactive states are archived after this many days without a visit.
+ARCHIVE_AFTER_DAYS = int(os.environ.get("STATE_ARCHIVE_AFTER_DAYS", "30"))
+# Pristine (never modified) states are deleted after this many days unseen.
+PRISTINE_TTL_DAYS = int(os.environ.get("STATE_PRISTINE_TTL_DAYS", "7"))
+# How often the background archiver runs; 0 disables it.
+ARCHIVE_INTERVAL_SECONDS = int(os.environ.get("STATE_ARCHIVE_INTERVAL_SECONDS", "3600"))
+ARCHIVE_BATCH_SIZE = int(os.environ.get("STATE_ARCHIVE_BATCH_SIZE", "500"))
+# Only the holder of this lease archives; every worker runs the loop, and the
+# lease expires on its own if the holder dies mid-run.
+ARCHIVE_LEASE_ID = "client_state_archiver"
+ARCHIVE_LEASE_SECONDS = int(os.environ.get("STATE_ARCHIVE_LEASE_SECONDS", "900"))
+# last_seen is only rewritten on reads when older than this, so plain GETs
+# do not turn into a write per request.
+LAST_SEEN_RESOLUTION = timedelta(minutes=int(os.environ.get("STATE_LAST_SEEN_RESOLUTION_MINUTES", "60")))
+
+
+def compress_state(doc: Dict[str, Any]) -> Binary:
+    doc = {k: v for k, v in doc.items() if k != "_id"}
+    return Binary(zlib.compress(BSON.encode(doc)))
+
+
+def decompress_state(blob: bytes) -> Dict[str, Any]:
+    return BSON(zlib.decompress(blob)).decode()
+
+
+async def ensure_lifecycle_indexes(db):
+    await db.client_states.create_index("client_id", unique=True)
+    await db.client_states.create_index("last_seen")
+    await ensure_ttl_index(
+        db.client_states,
+        "last_seen",
+        PRISTINE_TTL_DAYS * 86400,
+        name="pristine_ttl",
+        partialFilterExpression={"pristine": True},
+    )
+    await db[ARCHIVE_COLLECTION].create_index("client_id", unique=True)
+
+
+async def touch_last_seen(db, client_id: str, last_seen: Optional[datetime]) -> Optional[datetime]:
+    """Refresh last_seen on a read, at most once per LAST_SEEN_RESOLUTION.
+
+    Returns the new value if it was written, otherwise None.
+    """
+    now = datetime.utcnow()
+    if last_seen is not None and now - last_seen < LAST_SEEN_RESOLUTION:
+        return None
+    await db.client_states.update_one({"client_id": client_id}, {"$set": {"last_seen": now}})
+    return now
+
+
+async def rehydrate_state(db, client_id: str) -> Optional[Dict[str, Any]]:
+    """Move an archived state back into the hot collection, if there is one.
+
+    The hot copy is written before the archived one is deleted, so a failure
+    in between leaves the state in both places rather than in neither.
+    """
+    archived = await db[ARCHIVE_COLLECTION].find_one({"client_id": client_id})
+    if not archived:
+        return None
+    doc = decompress_state(archived["data"])
+    doc["last_seen"] = datetime.utcnow()
+    try:
+        await db.client_states.insert_one(dict(doc))
+    except DuplicateKeyError:
+        # A concurrent request rehydrated (or recreated) it first.
+        doc = await db.client_states.find_one({"client_id": client_id})
+    else:
+        logger.info("Rehydrated archived client state %s", client_id)
+    await db[ARCHIVE_COLLECTION].delete_one({"_id": archived["_id"]})
+    return doc
+
+
+def _inactive_filter(cutoff: datetime) -> Dict[str, Any]:
+    return {
+        "pristine": {"$ne": True},
+        "$or": [
+            {"last_seen": {"$lt": cutoff}},
+            # documents written before last_seen existed
+            {"last_seen": {"$exists": False}, "updated_at": {"$lt": cutoff}},
+        ],
+    }
+
+
+async def archive_inactive_states(db, older_than: Optional[timedelta] = None, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """Move states not seen since ``older_than`` into the archive collection.
+
+    Each batch is written to the archive before it is removed from the hot
+    collection. A document is only removed if its last_seen did not change in
+    the meantime; copies of documents touched during the run are dropped from
+    the archive again.
+    """
+    cutoff = datetime.utcnow() - (older_than if older_than is not None else timedelta(days=ARCHIVE_AFTER_DAYS))
+    cursor = db.client_states.find(_inactive_filter(cutoff), batch_size=batch_size)
+    archived = 0
+    batch: List[Dict[str, Any]] = []
+    async for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            archived += await _archive_batch(db, batch)
+            batch = []
+    if batch:
+        archived += await _archive_batch(db, batch)
+    if archived:
+        logger.info("Archived %d inactive client states", archived)
+    return archived
+
+
+async def _archive_batch(db, batch: List[Dict[str, Any]]) -> int:
+    now = datetime.utcnow()
+    await db[ARCHIVE_COLLECTION].bulk_write(
+        [
+            ReplaceOne(
+                {"client_id": doc["client_id"]},
+                {"client_id": doc["client_id"], "archived_at": now, "data": compress_state(doc)},
+                upsert=True,
+            )
+            for doc in batch
+        ],
+        ordered=False,
+    )
+    moved = 0
+    kept = []
+    for doc in batch:
+        res = await db.client_states.delete_one({"_id": doc["_id"], "last_seen": doc.get("last_seen")})
+        if res.deleted_count:
+            moved += 1
+        elif await db.client_states.find_one({"_id": doc["_id"]}, {"_id": 1}) is not None:
+            # touched since it was read; the hot copy is current
+            kept.append(doc["client_id"])
+        # otherwise another archiver moved it first, and the archive copy is
+        # the only one left
+    if kept:
+        await db[ARCHIVE_COLLECTION].delete_many({"client_id": {"$in": kept}})
+    return moved
+
+
+async def acquire_lease(db, name: str, owner: str, seconds: int) -> bool:
+    """Take (or renew) the lease ``name`` for ``seconds``; False if someone else holds it."""
+    now = datetime.utcnow()
+    try:
+        await db.leases.update_one(
+            {"_id": name, "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=seconds)}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+async def release_lease(db, name: str, owner: str):
+    await db.leases.delete_one({"_id": name, "owner": owner})
+
+
+async def run_archiver(db, interval: int = ARCHIVE_INTERVAL_SECONDS):
+    """Background loop calling archive_inactive_states every ``interval`` seconds.
+
+    Runs in every worker; each round only the worker holding the archiver
+    lease does the work.
+    """
+    owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if not await acquire_lease(db, ARCHIVE_LEASE_ID, owner, ARCHIVE_LEASE_SECONDS):
+                continue
+            try:
+                await archive_inactive_states(db)
+            finally:
+                await release_lease(db, ARCHIVE_LEASE_ID, owner)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Client state archival failed")
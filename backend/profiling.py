@@ -0,0 +1,336 @@
+"""On-demand profiling and slow-request diagnostics.
+
+- ``sample_stacks`` runs a sampling profiler on a background thread for a set
+  duration and returns collapsed stacks ("frame;frame;frame count" lines),
+  the input format of flamegraph.pl, speedscope and similar tools.
+- ``SlowRequestMiddleware`` snapshots the await stack of any request still
+  running after SLOW_REQUEST_MS, together with the Mongo commands it issued
+  (collected by ``mongo_tracer``), and keeps the last SLOW_REQUEST_BUFFER of
+  them in the app's ``SlowRequestLog``. Await snapshots only run when the loop is free, so a
+  watchdog thread also samples the loop thread's stack while a slow request
+  is in flight; that is what shows synchronous work (validation, encoding)
+  holding the loop.
+- ``LoopLagMonitor`` measures how late the event loop wakes from a sleep,
+  which is time the loop spent blocked by synchronous work.
+"""
+import asyncio
+import contextvars
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional
+
+from pymongo import monitoring
+
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "1000"))
+SLOW_REQUEST_BUFFER = int(os.environ.get("SLOW_REQUEST_BUFFER", "100"))
+# stack snapshots taken per slow request (one every SLOW_REQUEST_MS)
+SLOW_REQUEST_SNAPSHOTS = 10
+# how often the watchdog samples the loop thread during a slow request
+SLOW_REQUEST_SAMPLE_MS = float(os.environ.get("SLOW_REQUEST_SAMPLE_MS", "10"))
+# distinct loop stacks kept per slow request, most frequent first
+LOOP_SAMPLE_STACKS = 20
+LOOP_LAG_INTERVAL_MS = float(os.environ.get("LOOP_LAG_INTERVAL_MS", "500"))
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "60"))
+# Mongo commands kept per request trace (long exports issue many getMores)
+MAX_TRACED_COMMANDS = 200
+
+
+def _frame_label(code, lineno: int) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{lineno})"
+
+
+def _collapse(frame) -> List[str]:
+    """Labels of a thread's frame stack, outermost first."""
+    stack = []
+    while frame is not None:
+        stack.append(_frame_label(frame.f_code, frame.f_lineno))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def _await_stack(task: asyncio.Task) -> List[str]:
+    """Labels of the coroutine chain a suspended task is awaiting, outermost first.
+
+    ``Task.get_stack()`` only returns the outermost frame of a suspended
+    task, so follow ``cr_await`` / ``gi_yieldfrom`` down instead.
+    """
+    frames = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None) or getattr(coro, "ag_frame", None)
+        if frame is None:
+            break
+        frames.append(_frame_label(frame.f_code, frame.f_lineno))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None) or getattr(coro, "ag_await", None)
+    return frames
+
+
+# ------------------------
+# SAMPLING PROFILER
+# ------------------------
+_profile_lock = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def sample_stacks(seconds: float, interval: float = 0.005, thread_ids: Optional[List[int]] = None) -> str:
+    """Sample thread stacks for ``seconds``; returns collapsed stacks.
+
+    Only ``thread_ids`` are sampled if given, otherwise every thread except
+    the sampler itself. Blocking: run it in a worker thread.
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfilerBusy("A profile is already running")
+    try:
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        counts: Counter = Counter()
+        deadline = time.monotonic() + min(seconds, PROFILE_MAX_SECONDS)
+        while time.monotonic() < deadline:
+            for tid, frame in sys._current_frames().items():
+                if tid == me or (thread_ids is not None and tid not in thread_ids):
+                    continue
+                stack = [names.get(tid, f"thread-{tid}")] + _collapse(frame)
+                counts[";".join(stack)] += 1
+            time.sleep(interval)
+        return "".join(f"{stack} {n}\n" for stack, n in counts.most_common())
+    finally:
+        _profile_lock.release()
+
+
+# ------------------------
+# MONGO COMMAND TRACING
+# ------------------------
+# Motor copies the calling context into its executor threads, so listener
+# callbacks see the trace list of the request that issued the command.
+_request_trace: contextvars.ContextVar[Optional[List[Dict[str, Any]]]] = contextvars.ContextVar(
+    "request_trace", default=None
+)
+
+
+class MongoTracer(monitoring.CommandListener):
+    def started(self, event):
+        trace = _request_trace.get()
+        if trace is not None and len(trace) < MAX_TRACED_COMMANDS:
+            trace.append({
+                "request_id": event.request_id,
+                "command": event.command_name,
+                "collection": event.command.get(event.command_name) if event.command_name != "getMore" else event.command.get("collection"),
+                "duration_ms": None,
+                "ok": None,
+            })
+
+    def _finish(self, event, ok: bool):
+        trace = _request_trace.get()
+        if trace is None:
+            return
+        for entry in reversed(trace):
+            if entry["request_id"] == event.request_id:
+                entry["duration_ms"] = event.duration_micros / 1000
+                entry["ok"] = ok
+                break
+
+    def succeeded(self, event):
+        self._finish(event, True)
+
+    def failed(self, event):
+        self._finish(event, False)
+
+
+mongo_tracer = MongoTracer()
+
+
+# ------------------------
+# SLOW REQUESTS
+# ------------------------
+class LoopWatchdog:
+    """Samples one thread's stack from a daemon thread while a registered request is overdue.
+
+    While nothing is registered the thread blocks on an event; the first
+    registration wakes it once to sleep until that request would cross
+    ``threshold``. It only samples every ``interval`` while some request is
+    overdue, so requests that finish in time cost at most that one wake-up.
+    """
+
+    def __init__(self, thread_id: int, threshold: float, interval: float = SLOW_REQUEST_SAMPLE_MS / 1000):
+        self.thread_id = thread_id
+        self.threshold = threshold
+        self.interval = interval
+        self._active: Dict[int, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def register(self, start: float) -> Dict[str, Any]:
+        record = {"start": start, "samples": Counter()}
+        with self._lock:
+            idle = not self._active
+            self._active[id(record)] = record
+        # starts only increase, so a new record is never due before the
+        # ones the thread is already sleeping on
+        if idle:
+            self._wake.set()
+        return record
+
+    def unregister(self, record: Dict[str, Any]) -> Counter:
+        with self._lock:
+            self._active.pop(id(record), None)
+            return record["samples"]
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+
+    def _run(self):
+        while not self._stopped:
+            with self._lock:
+                starts = [r["start"] for r in self._active.values()]
+            if not starts:
+                timeout = None
+            else:
+                timeout = max(self.interval, min(starts) + self.threshold - time.perf_counter())
+            if self._wake.wait(timeout):
+                self._wake.clear()
+                continue
+            now = time.perf_counter()
+            with self._lock:
+                due = [r for r in self._active.values() if now - r["start"] >= self.threshold]
+            if not due:
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = ";".join(_collapse(frame))
+            del frame
+            with self._lock:
+                for record in due:
+                    record["samples"][stack] += 1
+
+
+class SlowRequestLog:
+    """One app's recent slow requests (newest last) and the watchdog sampling its loop."""
+
+    def __init__(self, threshold_ms: float = SLOW_REQUEST_MS, maxlen: int = SLOW_REQUEST_BUFFER):
+        self.threshold = threshold_ms / 1000
+        self.entries: Deque[Dict[str, Any]] = deque(maxlen=maxlen)
+        self.watchdog: Optional[LoopWatchdog] = None
+
+    def start(self, thread_id: int):
+        """Start the watchdog for the event loop running on ``thread_id``."""
+        if self.threshold > 0 and SLOW_REQUEST_SAMPLE_MS > 0 and self.watchdog is None:
+            self.watchdog = LoopWatchdog(thread_id, self.threshold)
+
+    def stop(self):
+        if self.watchdog:
+            self.watchdog.stop()
+            self.watchdog = None
+
+    def recent(self) -> List[Dict[str, Any]]:
+        return list(reversed(self.entries))
+
+
+class SlowRequestMiddleware:
+    """Records requests slower than the log's threshold with stack snapshots and Mongo traces."""
+
+    def __init__(self, app, log: SlowRequestLog):
+        self.app = app
+        self.log = log
+        self.threshold = log.threshold
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.threshold <= 0:
+            return await self.app(scope, receive, send)
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        trace: List[Dict[str, Any]] = []
+        token = _request_trace.set(trace)
+        snapshots: List[Dict[str, Any]] = []
+        status = {"code": None}
+        start = time.perf_counter()
+        watchdog = self.log.watchdog
+        record = watchdog.register(start) if watchdog else None
+
+        def snapshot():
+            # runs on the loop, so the request task is suspended in an await
+            snapshots.append({"elapsed_ms": round((time.perf_counter() - start) * 1000, 1), "stack": _await_stack(task)})
+            if len(snapshots) < SLOW_REQUEST_SNAPSHOTS:
+                handle[0] = loop.call_later(self.threshold, snapshot)
+
+        handle = [loop.call_later(self.threshold, snapshot)]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            handle[0].cancel()
+            _request_trace.reset(token)
+            loop_samples = watchdog.unregister(record) if watchdog else Counter()
+            elapsed = time.perf_counter() - start
+            if elapsed >= self.threshold:
+                self.log.entries.append({
+                    "at": datetime.utcnow().isoformat(),
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status": status["code"],
+                    "duration_ms": round(elapsed * 1000, 1),
+                    "snapshots": snapshots,
+                    # what the loop thread was executing meanwhile, for this or any other request
+                    "loop_samples": [{"stack": st, "count": n} for st, n in loop_samples.most_common(LOOP_SAMPLE_STACKS)],
+                    "mongo": [{k: v for k, v in e.items() if k != "request_id"} for e in trace],
+                })
+
+
+# ------------------------
+# EVENT LOOP LAG
+# ------------------------
+class LoopLagMonitor:
+    """Sleeps ``interval`` seconds in a loop and records how late each wake-up was."""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL_MS / 1000, window: int = 120):
+        self.interval = interval
+        self.recent: Deque[float] = deque(maxlen=window)
+        self.max_lag = 0.0
+        self.samples = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - start - self.interval)
+            self.recent.append(lag)
+            self.samples += 1
+            self.max_lag = max(self.max_lag, lag)
+
+    def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        recent = sorted(self.recent)
+        return {
+            "interval_ms": self.interval * 1000,
+            "samples": self.samples,
+            "last_ms": self.recent[-1] * 1000 if self.recent else 0.0,
+            "avg_ms": sum(recent) / len(recent) * 1000 if recent else 0.0,
+            "p99_ms": recent[min(len(recent) - 1, int(len(recent) * 0.99))] * 1000 if recent else 0.0,
+            "max_ms": self.max_lag * 1000,
+        }
@@ -0,0 +1,218 @@
+"""Token-bucket rate limiting and load shedding middleware.
+
+Writes under ``/api/state/{client_id}/...`` are limited by two token buckets,
+one per client_id and one per client IP. A global concurrency limit covers
+every API request except health probes: when all slots are busy a request
+waits briefly for one, and is shed with 503 if none frees up. Rejections
+carry a ``Retry-After`` header.
+
+Settings (env): RATE_LIMIT_ENABLED, RATE_LIMIT_CLIENT_RATE / _BURST,
+RATE_LIMIT_IP_RATE / _BURST, RATE_LIMIT_MAX_KEYS, MAX_CONCURRENT_REQUESTS
+(0 disables), CONCURRENCY_QUEUE_TIMEOUT_MS, CONCURRENCY_MAX_WAITING,
+TRUST_FORWARDED_FOR, TRUSTED_PROXY_HOPS.
+
+The per-IP bucket only applies when TRUST_FORWARDED_FOR is set: behind a
+proxy every request has the same socket peer, and keying on it would turn
+the bucket into one global budget. Only set it behind proxies that append to
+``X-Forwarded-For``: the client is then the entry TRUSTED_PROXY_HOPS
+(default 1) from the right. Entries further left are supplied by the client
+and are never used; requests with fewer entries fall back to the peer address.
+"""
+import asyncio
+import json
+import math
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+WRITE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+STATE_PATH = re.compile(r"^/api/state/([^/]+)/")
+EXEMPT_PREFIXES = ("/api/health/",)
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+class TokenBuckets:
+    """Token buckets keyed by string, bounded to ``max_keys`` with LRU eviction.
+
+    Each entry is a two-item list ``[tokens, last_refill]``. An evicted key
+    simply starts again with a full bucket.
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, List[float]]" = OrderedDict()
+        self.rejected = 0
+
+    def take(self, key: str, now: Optional[float] = None) -> float:
+        """Consume one token; returns 0 if allowed, else seconds until one is available."""
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [self.burst, now]
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        self.rejected += 1
+        return (1 - bucket[0]) / self.rate
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class ConcurrencyLimiter:
+    """Caps in-flight requests; waits up to ``queue_timeout`` for a free slot."""
+
+    def __init__(self, limit: int, queue_timeout: float = 0.1, max_waiting: int = 1000):
+        self.limit = limit
+        self.queue_timeout = queue_timeout
+        self.max_waiting = max_waiting
+        self.in_flight = 0
+        self.waiting = 0
+        self.shed = 0
+        self._released = asyncio.Condition()
+
+    async def acquire(self) -> bool:
+        if self.in_flight < self.limit:
+            self.in_flight += 1
+            return True
+        if self.waiting >= self.max_waiting or self.queue_timeout <= 0:
+            self.shed += 1
+            return False
+        self.waiting += 1
+        try:
+            async with self._released:
+                await asyncio.wait_for(
+                    self._released.wait_for(lambda: self.in_flight < self.limit), self.queue_timeout
+                )
+                self.in_flight += 1
+                return True
+        except asyncio.TimeoutError:
+            self.shed += 1
+            return False
+        finally:
+            self.waiting -= 1
+
+    async def release(self):
+        self.in_flight -= 1
+        if self.waiting:
+            async with self._released:
+                self._released.notify()
+
+
+class Limits:
+    """Limiter state shared by the middleware and the admin metrics endpoint."""
+
+    def __init__(self):
+        max_keys = int(os.environ.get("RATE_LIMIT_MAX_KEYS", "100000"))
+        self.enabled = os.environ.get("RATE_LIMIT_ENABLED", "1") not in ("0", "false", "False")
+        self.trust_forwarded_for = os.environ.get("TRUST_FORWARDED_FOR", "0") not in ("0", "false", "False")
+        self.proxy_hops = max(1, int(os.environ.get("TRUSTED_PROXY_HOPS", "1")))
+        self.per_client = TokenBuckets(
+            _env_float("RATE_LIMIT_CLIENT_RATE", 5), _env_float("RATE_LIMIT_CLIENT_BURST", 20), max_keys
+        )
+        self.per_ip = TokenBuckets(
+            _env_float("RATE_LIMIT_IP_RATE", 20), _env_float("RATE_LIMIT_IP_BURST", 100), max_keys
+        )
+        limit = int(os.environ.get("MAX_CONCURRENT_REQUESTS", "256"))
+        self.concurrency = (
+            ConcurrencyLimiter(
+                limit,
+                _env_float("CONCURRENCY_QUEUE_TIMEOUT_MS", 100) / 1000,
+                int(os.environ.get("CONCURRENCY_MAX_WAITING", "1000")),
+            )
+            if limit > 0
+            else None
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = {
+            "enabled": self.enabled,
+            "client_buckets": len(self.per_client),
+            "client_rejected": self.per_client.rejected,
+            "ip_buckets": len(self.per_ip),
+            "ip_rejected": self.per_ip.rejected,
+        }
+        if self.concurrency:
+            stats.update(
+                in_flight=self.concurrency.in_flight,
+                waiting=self.concurrency.waiting,
+                concurrency_limit=self.concurrency.limit,
+                shed=self.concurrency.shed,
+            )
+        return stats
+
+
+async def _reject(send, status: int, detail: str, retry_after: float):
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class RateLimitMiddleware:
+    """Pure ASGI middleware so rejected requests never reach routing or pydantic."""
+
+    def __init__(self, app, limits: Limits):
+        self.app = app
+        self.limits = limits
+
+    def _client_ip(self, scope) -> str:
+        if self.limits.trust_forwarded_for:
+            # each trusted proxy appends the address it received from; repeated
+            # headers are one list in order
+            hops: List[str] = []
+            for name, value in scope.get("headers", ()):
+                if name == b"x-forwarded-for":
+                    hops.extend(h.strip() for h in value.decode("latin-1").split(","))
+            if len(hops) >= self.limits.proxy_hops:
+                return hops[-self.limits.proxy_hops]
+        client = scope.get("client")
+        return client[0] if client else "unknown"
+
+    async def __call__(self, scope, receive, send):
+        limits = self.limits
+        if scope["type"] != "http" or not limits.enabled:
+            return await self.app(scope, receive, send)
+        path = scope["path"]
+        if path.startswith(EXEMPT_PREFIXES):
+            return await self.app(scope, receive, send)
+
+        if scope["method"] in WRITE_METHODS:
+            match = STATE_PATH.match(path)
+            if match:
+                wait = limits.per_client.take(match.group(1))
+                if not wait and limits.trust_forwarded_for:
+                    wait = limits.per_ip.take(self._client_ip(scope))
+                if wait:
+                    return await _reject(send, 429, "Too many requests", wait)
+
+        concurrency = limits.concurrency
+        if concurrency is None:
+            return await self.app(scope, receive, send)
+        if not await concurrency.acquire():
+            return await _reject(send, 503, "Server busy", 1)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            await concurrency.release()
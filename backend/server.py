@@ -1,31 +1,67 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, Query, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
 import os
 import logging
+from contextlib import asynccontextmanager
 from pathlib import Path
 from pydantic import BaseModel, Field
 from typing import List, Dict, Optional, Any
+import asyncio
+import hmac
+import threading
+import time
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
 
 ROOT_DIR = Path(__file__).parent
+# Only reads the file; settings are consumed lazily (see database.py). Loaded
+# before the local imports below so their env-based defaults see it.
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+from database import close_client, get_catalog_db, get_db, operation_timeout, pool_metrics, retry_with_backoff
+from lifecycle import (
+    ARCHIVE_INTERVAL_SECONDS,
+    ensure_lifecycle_indexes,
+    rehydrate_state,
+    run_archiver,
+    touch_last_seen,
+)
+from cache import FLUSH_ALL, InvalidationBus, LocalBus, LRUCache, cache_stats, create_bus
+from catalog import CATALOG_PATH, Catalog, ensure_catalog_indexes, load_catalog, load_catalog_from_db, sync_catalog
+from profiling import LoopLagMonitor, ProfilerBusy, SlowRequestLog, SlowRequestMiddleware, sample_stacks
+from ratelimit import Limits, RateLimitMiddleware
+from statuschecks import ensure_status_indexes, migrate_legacy_checks, recent_checks, record_check, summarize
+from transfer import TransferError, check_collection, export_collection, import_collection, iter_lines
 
-# Create the main app without a prefix
-app = FastAPI()
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+READY_PING_TIMEOUT = float(os.environ.get("READY_PING_TIMEOUT_SECONDS", "1"))
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
 
+async def require_admin(x_admin_token: Optional[str] = Header(None)):
+    expected = os.environ.get("ADMIN_TOKEN")
+    if not expected:
+        raise HTTPException(status_code=403, detail="Admin API disabled")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, expected):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+# Admin endpoints require the X-Admin-Token header to match ADMIN_TOKEN
+admin_router = APIRouter(prefix="/api/admin", dependencies=[Depends(require_admin)])
+
+
 # ------------------------
 # MODELS
 # ------------------------
@@ -37,6 +73,11 @@ class StatusCheck(BaseModel):
 class StatusCheckCreate(BaseModel):
     client_name: str
 
+class StatusSummary(BaseModel):
+    client_name: str
+    start: datetime
+    count: int
+
 class Resource(BaseModel):
     title: str
     url: str
@@ -77,214 +118,171 @@ class ClientState(BaseModel):
     notes: Optional[str] = ""
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
+    last_seen: datetime = Field(default_factory=datetime.utcnow)
 
 # ------------------------
-# SEED DATA (idempotent)
+# APP CONTEXT
 # ------------------------
-BRANCHES_DATA: List[Dict[str, Any]] = [
-  {
-    "slug": "cognitive",
-    "name": "Cognitive Psychology",
-    "level": "Beginner",
-    "heroImage": "https://images.unsplash.com/photo-1617791160536-598cf32026fb?q=85&w=1600",
-    "summary": "Studies mental processes like attention, memory, language, problem-solving, and decision-making.",
-    "keyIdeas": [
-      "Information processing models",
-      "Working memory (Baddeley & Hitch)",
-      "Schemas and cognitive biases",
-      "Dual-process theory (System 1 & 2)"
-    ],
-    "psychologists": ["Ulric Neisser", "Daniel Kahneman", "Amos Tversky", "Elizabeth Loftus"],
-    "mnemonics": [
-      {"title": "Memory Stages", "hint": "AESR → Attention, Encoding, Storage, Retrieval"},
-      {"title": "Working Memory", "hint": "Phonological loop = sound, Visuospatial sketchpad = sight, Episodic buffer = integrates"}
-    ],
-    "resources": [
-      {"title": "Verywell Mind: Cognitive Psychology", "url": "https://www.verywellmind.com/what-is-cognitive-psychology-2794982"},
-      {"title": "Khan Academy: Cognition", "url": "https://www.khanacademy.org/test-prep/mcat/processing-the-environment"}
-    ],
-    "activities": [
-      "Keep a decision diary for one week; tag fast vs slow decisions",
-      "Test your memory with 7 ± 2 digit spans and chunking"
-    ],
-    "quiz": [
-      {"q": "Which component of working memory is responsible for holding and manipulating visual information?",
-       "options": ["Central executive", "Visuospatial sketchpad", "Phonological loop", "Episodic buffer"],
-       "answer": 1,
-       "explain": "The visuospatial sketchpad holds and manipulates visual and spatial info."},
-      {"q": "System 1 thinking is best described as:",
-       "options": ["Slow and analytical", "Effortful and deliberate", "Fast and intuitive", "Statistical and logical"],
-       "answer": 2,
-       "explain": "System 1 is rapid, automatic, and heuristic-driven."}
-    ],
-    "schedule": [
-      {"text": "Read overview of cognitive models", "done": False},
-      {"text": "Practice memory techniques (chunking, elaborative rehearsal)",       "done": False},
-      {"text": "Summarize 2 biases with real examples", "done": False}
-    ]
-  },
-  {
-    "slug": "developmental",
-    "name": "Developmental Psychology",
-    "level": "Beginner",
-    "heroImage": "https://images.unsplash.com/photo-1598963374368-f47f4603b7d4?q=85&w=1600",
-    "summary": "Explores human growth and change across the lifespan in cognition, emotion, and social behavior.",
-    "keyIdeas": [
-      "Piaget's stages",
-      "Vygotsky's sociocultural theory",
-      "Attachment styles (Ainsworth/Bowlby)",
-      "Erikson's psychosocial stages"
-    ],
-    "psychologists": ["Jean Piaget", "Lev Vygotsky", "Mary Ainsworth", "Erik Erikson"],
-    "mnemonics": [
-      {"title": "Piaget Stages", "hint": "Some People Can Fly → Sensorimotor, Preoperational, Concrete, Formal"},
-      {"title": "Erikson Order", "hint": "TA III GII → Trust, Autonomy, Initiative, Industry, Identity, Intimacy, Generativity, Integrity"}
-    ],
-    "resources": [
-      {"title": "SimplyPsychology: Piaget", "url": "https://www.simplypsychology.org/piaget.html"},
-      {"title": "CrashCourse: Development", "url": "https://www.youtube.com/watch?v=d6I6UpuJQbI"}
-    ],
-    "activities": ["Map your own development milestones", "Observe a child-parent interaction and note attachment cues"],
-    "quiz": [
-      {"q": "Which concept describes the range of tasks a child can perform with guidance but not alone?",
-       "options": ["Assimilation", "Scaffolding", "Zone of Proximal Development", "Accommodation"],
-       "answer": 2,
-       "explain": "Vygotsky's ZPD defines this range; scaffolding supports progress within it."}
-    ],
-    "schedule": [
-      {"text": "Review Piaget stages with examples", "done": False},
-      {"text": "Watch video on attachment styles", "done": False}
-    ]
-  },
-  {
-    "slug": "social",
-    "name": "Social Psychology",
-    "level": "Intermediate",
-    "heroImage": "https://images.unsplash.com/photo-1560452192-ce93f2f642e2?q=85&w=1600",
-    "summary": "Examines how individuals think, feel, and behave in social contexts (groups, norms, persuasion).",
-    "keyIdeas": ["Attribution theory", "Conformity (Asch)", "Obedience (Milgram)", "Bystander effect"],
-    "psychologists": ["Solomon Asch", "Stanley Milgram", "Philip Zimbardo", "Henri Tajfel"],
-    "mnemonics": [
-      {"title": "Attribution Types", "hint": "DI → Dispositional vs. Situational"},
-      {"title": "Conformity Cues", "hint": "USAMI → Unanimity, Size, Ambiguity, Minority, Information"}
-    ],
-    "resources": [
-      {"title": "APA: Social Psychology", "url": "https://www.apa.org/action/science/social"},
-      {"title": "SimplyPsychology: Milgram", "url": "https://www.simplypsychology.org/milgram.html"}
-    ],
-    "activities": ["Run a small conformity survey", "Analyze a public campaign for persuasion techniques"],
-    "quiz": [
-      {"q": "The bystander effect predicts:",
-       "options": ["Help increases as group size increases", "Help decreases as group size increases", "Help unaffected by group size", "Help only when trained"],
-       "answer": 1,
-       "explain": "Diffusion of responsibility reduces helping in larger groups."}
-    ],
-    "schedule": [
-      {"text": "Summarize 3 classic social experiments", "done": False},
-      {"text": "Observe group behavior in a meeting/class", "done": False}
-    ]
-  },
-  {
-    "slug": "clinical",
-    "name": "Clinical Psychology",
-    "level": "Intermediate",
-    "heroImage": "https://images.unsplash.com/photo-1562313081-0e82b5729071?q=85&w=1600",
-    "summary": "Assessment, diagnosis, and treatment of mental disorders; therapeutic approaches and ethics.",
-    "keyIdeas": ["CBT cognitive model", "Biopsychosocial formulation", "DSM-5-TR categories", "Therapeutic alliance"],
-    "psychologists": ["Aaron Beck", "Albert Ellis", "Carl Rogers", "Irvin Yalom"],
-    "mnemonics": [
-      {"title": "CBT Steps", "hint": "ATE → Automatic thoughts → Test → Evaluate"},
-      {"title": "Risk Assessment", "hint": "SAD PERSONS for suicide risk cues (use as study prompt only)"}
-    ],
-    "resources": [
-      {"title": "NICE Guidelines", "url": "https://www.nice.org.uk/guidance/conditions-and-diseases/mental-health-and-behavioural-conditions"},
-      {"title": "PsychDB", "url": "https://www.psychdb.com/"}
-    ],
-    "activities": ["Build a simple CBT thought record", "Practice reflective listening with a peer"],
-    "quiz": [
-      {"q": "Which therapy emphasizes unconditional positive regard?",
-       "options": ["CBT", "Person-centered therapy", "REBT", "Behavioral activation"],
-       "answer": 1,
-       "explain": "Rogers' person-centered therapy emphasizes empathy and unconditional positive regard."}
-    ],
-    "schedule": [
-      {"text": "Read CBT basics and do one thought record", "done": False},
-      {"text": "Review DSM-5-TR anxiety disorders overview", "done": False}
-    ]
-  },
-  {
-    "slug": "biological",
-    "name": "Biological Psychology",
-    "level": "Intermediate",
-    "heroImage": "https://images.pexels.com/photos/8378740/pexels-photo-8378740.jpeg",
-    "summary": "Links brain, neurotransmitters, hormones, and genetics with behavior and mental processes.",
-    "keyIdeas": ["Neurotransmission", "Brain imaging (fMRI, EEG)", "Neuroplasticity", "Endocrine influences"],
-    "psychologists": ["Donald Hebb", "Roger Sperry", "Eric Kandel", "Brenda Milner"],
-    "mnemonics": [
-      {"title": "Neurotransmitters", "hint": "SAND → Serotonin, Acetylcholine, Norepinephrine, Dopamine"},
-      {"title": "Lobes", "hint": "F POT → Frontal, Parietal, Occipital, Temporal"}
-    ],
-    "resources": [
-      {"title": "Neuroscience News", "url": "https://neurosciencenews.com/"},
-      {"title": "Khan Academy: Neuro", "url": "https://www.khanacademy.org/test-prep/mcat/processing-the-environment/neural"}
-    ],
-    "activities": ["Label a brain diagram and quiz yourself", "Summarize a recent neuro study in 5 lines"],
-    "quiz": [
-      {"q": "The primary excitatory neurotransmitter in the CNS is:",
-       "options": ["GABA", "Serotonin", "Glutamate", "Dopamine"],
-       "answer": 2,
-       "explain": "Glutamate is the main excitatory neurotransmitter in the CNS."}
-    ],
-    "schedule": [
-      {"text": "Review neuron anatomy and synapse steps", "done": False},
-      {"text": "Compare fMRI vs EEG use-cases", "done": False}
-    ]
-  },
-  {
-    "slug": "methods",
-    "name": "Research Methods",
-    "level": "Beginner",
-    "heroImage": "https://images.pexels.com/photos/4046718/pexels-photo-4046718.jpeg",
-    "summary": "Designing studies, variables, reliability/validity, statistics, ethics, and replication.",
-    "keyIdeas": ["Operationalization", "Experimental vs correlational", "Reliability & validity", "p-values and confidence intervals"],
-    "psychologists": ["Karl Popper", "Paul Meehl", "Jacob Cohen", "Ronald Fisher"],
-    "mnemonics": [
-      {"title": "Validity Types", "hint": "CICE → Construct, Internal, Criterion, External"},
-      {"title": "Biases", "hint": "SSPR → Sampling, Selection, Publication, Researcher"}
-    ],
-    "resources": [
-      {"title": "Coursera: Methods", "url": "https://www.coursera.org/learn/research-methods"},
-      {"title": "Laerd Statistics", "url": "https://statistics.laerd.com/"}
-    ],
-    "activities": ["Turn a vague idea into operational variables", "Critique a methods section of a paper"],
-    "quiz": [
-      {"q": "Which best increases internal validity?",
-       "options": ["Random sampling", "Random assignment", "Larger sample size", "Double-blind peer review"],
-       "answer": 1,
-       "explain": "Random assignment balances confounds across experimental groups."}
-    ],
-    "schedule": [
-      {"text": "Define IV/DV for 3 research questions", "done": False},
-      {"text": "Revise reliability vs validity with examples", "done": False}
-    ]
-  }
-]
-
-async def seed_branches():
-    existing = await db.branches.count_documents({})
-    if existing == 0:
-        await db.branches.insert_many(BRANCHES_DATA)
-        logging.info("Seeded branches collection with default data")
-
-async def ensure_client_state(client_id: str) -> ClientState:
-    doc = await db.client_states.find_one({"client_id": client_id})
-    if not doc:
-        state = ClientState(client_id=client_id)
-        await db.client_states.insert_one(state.model_dump())
-        return state
-    # Convert nested tasks to TaskItem list
-    # Pydantic will coerce on model creation
-    return ClientState(**doc)
+def parse_branch(raw: Dict[str, Any]) -> Branch:
+    return Branch(**raw)
+
+def read_catalog_file() -> Catalog:
+    return load_catalog(CATALOG_PATH, parse_branch)
+
+def state_update(fields: Dict[str, Any]) -> Dict[str, Any]:
+    """Build a client_states update that also marks the state as active and modified."""
+    now = datetime.utcnow()
+    return {
+        "$set": {**fields, "updated_at": now, "last_seen": now},
+        "$unset": {"pristine": ""},
+    }
+
+class AppContext:
+    """Everything one app instance owns: Mongo handles, caches, catalog and background tasks.
+
+    create_app() stores it on ``app.state.ctx`` and routes reach it through
+    the ``get_ctx`` dependency, so two apps in one process share nothing.
+    """
+
+    def __init__(self, database=None):
+        # overrides the Mongo database (tests); bound in lifespan otherwise
+        self.database = database
+        # catalog reads use catalog_db, which may prefer secondaries
+        self.db = None
+        self.catalog_db = None
+        # Per-worker caches; other workers are told about writes through the
+        # invalidation bus (see cache.py), replaced on startup according to
+        # CACHE_INVALIDATION.
+        self.state_cache = LRUCache(
+            maxsize=int(os.environ.get("STATE_CACHE_SIZE", "10000")),
+            ttl=float(os.environ.get("STATE_CACHE_TTL_SECONDS", "300")),
+        )
+        self.bus: InvalidationBus = LocalBus()
+        # The branch catalog is loaded from data/branches.json and served from
+        # memory. A new snapshot is swapped in with a single assignment, so
+        # requests always see one consistent version.
+        self.catalog: Optional[Catalog] = None
+        self.catalog_lock = asyncio.Lock()
+        self.archiver_task: Optional[asyncio.Task] = None
+        self.warmup_task: Optional[asyncio.Task] = None
+        self.loop_lag = LoopLagMonitor()
+        self.loop_thread_id: Optional[int] = None
+        self.slow_requests = SlowRequestLog()
+
+    async def on_invalidation(self, kind: str, key: str):
+        if kind == "state":
+            self.state_cache.pop(key)
+        elif kind == "catalog":
+            await self.refresh_catalog_from_db(min_version=int(key))
+        elif kind == FLUSH_ALL:
+            self.state_cache.clear()
+            await self.refresh_catalog_from_db()
+
+    async def flush_states(self):
+        """Drop every cached client state, here and in the other workers."""
+        self.state_cache.clear()
+        await self.bus.publish(FLUSH_ALL, "")
+
+    # Catalog
+    def current_catalog(self) -> Catalog:
+        if self.catalog is None:
+            raise HTTPException(status_code=503, detail="Catalog not loaded")
+        return self.catalog
+
+    def require_branch(self, slug: str) -> Branch:
+        branch = self.current_catalog().by_slug.get(slug)
+        if branch is None:
+            raise HTTPException(status_code=404, detail="Unknown branch slug")
+        return branch
+
+    async def install_catalog(self, new: Catalog) -> Dict[str, Any]:
+        """Sync ``new`` to Mongo and make it the served snapshot."""
+        async with self.catalog_lock:
+            result = await sync_catalog(self.db, new)
+            if not result["skipped"]:
+                self.catalog = new
+                await self.bus.publish("catalog", str(new.version))
+        if result["skipped"]:
+            # the database already holds a newer version; serve that instead
+            await self.refresh_catalog_from_db()
+        return result
+
+    async def reload_catalog(self) -> Dict[str, Any]:
+        """Load the catalog file, sync changed branches to Mongo and swap it in."""
+        return await self.install_catalog(await asyncio.to_thread(read_catalog_file))
+
+    async def refresh_catalog_from_db(self, min_version: Optional[int] = None):
+        """Pick up a catalog another worker synced into Mongo."""
+        async with self.catalog_lock:
+            new = await load_catalog_from_db(self.catalog_db, parse_branch)
+            if min_version is not None and self.catalog_db is not self.db and (new is None or new.version < min_version):
+                # the secondary has not replicated the announced version yet
+                new = await load_catalog_from_db(self.db, parse_branch)
+            current = self.catalog
+            if new is None or (
+                current is not None
+                and (new.version < current.version or (new.version == current.version and new.hash == current.hash))
+            ):
+                return
+            self.catalog = new
+            logger.info("Catalog refreshed from database: v%s", new.version)
+
+    # Client state
+    async def ensure_client_state(self, client_id: str) -> ClientState:
+        db = self.db
+        with operation_timeout("read"):
+            state = self.state_cache.get(client_id)
+            if state is not None:
+                seen = await touch_last_seen(db, client_id, state.last_seen)
+                if seen:
+                    state.last_seen = seen
+                return state
+            ticket = self.state_cache.begin_fill(client_id)
+            doc = await db.client_states.find_one({"client_id": client_id})
+            if doc:
+                seen = await touch_last_seen(db, client_id, doc.get("last_seen"))
+                if seen:
+                    doc["last_seen"] = seen
+            else:
+                doc = await rehydrate_state(db, client_id)
+            if not doc:
+                state = ClientState(client_id=client_id)
+                # pristine states are expired by a TTL index until first modified
+                await db.client_states.update_one(
+                    {"client_id": client_id},
+                    {"$setOnInsert": {**state.model_dump(), "pristine": True}},
+                    upsert=True,
+                )
+            else:
+                # Convert nested tasks to TaskItem list
+                # Pydantic will coerce on model creation
+                state = ClientState(**doc)
+            # skipped if a write or invalidation for this client landed meanwhile
+            self.state_cache.fill(client_id, state, ticket)
+            return state
+
+    async def update_client_state(self, client_id: str, fields: Dict[str, Any]) -> ClientState:
+        """Apply ``fields`` to a client state, refresh the local cache and notify other workers."""
+        db = self.db
+        with operation_timeout("write"):
+            query = {"client_id": client_id}
+            doc = await db.client_states.find_one_and_update(
+                query, state_update(fields), projection={"_id": 0}, return_document=ReturnDocument.AFTER
+            )
+            if doc is None:
+                # not created yet, or archived since it was cached
+                self.state_cache.pop(client_id)
+                await self.ensure_client_state(client_id)
+                doc = await db.client_states.find_one_and_update(
+                    query, state_update(fields), projection={"_id": 0}, return_document=ReturnDocument.AFTER, upsert=True
+                )
+            state = ClientState(**doc)
+            self.state_cache.put(client_id, state)
+            await self.bus.publish("state", client_id)
+            return state
+
+def get_ctx(request: Request) -> AppContext:
+    return request.app.state.ctx
 
 # ------------------------
 # ROUTES
@@ -293,135 +291,331 @@ async def ensure_client_state(client_id: str) -> ClientState:
 async def root():
     return {"message": "Hello World"}
 
+# Health probes: liveness only says the event loop is serving; readiness also
+# requires the warm-up to have finished and Mongo to answer a ping.
+@api_router.get("/health/live")
+async def health_live():
+    return {"status": "ok"}
+
+@api_router.get("/health/ready")
+async def health_ready(ctx: AppContext = Depends(get_ctx)):
+    warmup_task = ctx.warmup_task
+    if ctx.catalog is None or warmup_task is None or not warmup_task.done():
+        raise HTTPException(status_code=503, detail="Warming up")
+    if warmup_task.cancelled() or warmup_task.exception():
+        raise HTTPException(status_code=503, detail="Warm-up failed")
+    try:
+        await asyncio.wait_for(ctx.db.command("ping"), timeout=READY_PING_TIMEOUT)
+    except Exception:
+        raise HTTPException(status_code=503, detail="Database unavailable")
+    return {"status": "ready", "catalog_version": ctx.catalog.version}
+
+def as_utc(dt: Optional[datetime]) -> Optional[datetime]:
+    """Stored datetimes are naive UTC; convert aware query parameters to match."""
+    if dt is not None and dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
 @api_router.post("/status", response_model=StatusCheck)
-async def create_status_check(input: StatusCheckCreate):
+async def create_status_check(input: StatusCheckCreate, ctx: AppContext = Depends(get_ctx)):
     status_obj = StatusCheck(**input.model_dump())
-    _ = await db.status_checks.insert_one(status_obj.model_dump())
+    await record_check(ctx.db, status_obj.model_dump())
     return status_obj
 
 @api_router.get("/status", response_model=List[StatusCheck])
-async def get_status_checks():
-    status_checks = await db.status_checks.find().to_list(1000)
+async def get_status_checks(
+    since: Optional[datetime] = None,
+    limit: int = Query(1000, ge=1, le=1000),
+    ctx: AppContext = Depends(get_ctx),
+):
+    status_checks = await recent_checks(ctx.db, limit=limit, since=as_utc(since))
     return [StatusCheck(**status_check) for status_check in status_checks]
 
+@api_router.get("/status/summary", response_model=List[StatusSummary])
+async def get_status_summary(
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    interval: int = Query(3600, ge=1, description="Interval in seconds, rounded up to the bucket width"),
+    ctx: AppContext = Depends(get_ctx),
+):
+    until = as_utc(until) or datetime.utcnow()
+    since = as_utc(since) or until - timedelta(days=1)
+    if since >= until:
+        raise HTTPException(status_code=422, detail="since must be before until")
+    return await summarize(ctx.db, since, until, interval)
+
 # Branches
 @api_router.get("/branches", response_model=List[Branch])
-async def list_branches():
-    items = await db.branches.find({}, {"_id": 0}).to_list(1000)
-    return [Branch(**it) for it in items]
+async def list_branches(ctx: AppContext = Depends(get_ctx)):
+    return ctx.current_catalog().items
 
 @api_router.get("/branches/{slug}", response_model=Branch)
-async def get_branch(slug: str):
-    doc = await db.branches.find_one({"slug": slug}, {"_id": 0})
-    if not doc:
+async def get_branch(slug: str, ctx: AppContext = Depends(get_ctx)):
+    branch = ctx.current_catalog().by_slug.get(slug)
+    if branch is None:
         raise HTTPException(status_code=404, detail="Branch not found")
-    return Branch(**doc)
+    return branch
 
 # Client state
 @api_router.get("/state/{client_id}", response_model=ClientState)
-async def get_state(client_id: str):
-    state = await ensure_client_state(client_id)
+async def get_state(client_id: str, ctx: AppContext = Depends(get_ctx)):
+    state = await ctx.ensure_client_state(client_id)
     return state
 
 class SetBookmark(BaseModel):
     bookmarked: bool
 
 @api_router.put("/state/{client_id}/bookmarks/{slug}")
-async def set_bookmark(client_id: str, slug: str, payload: SetBookmark):
+async def set_bookmark(client_id: str, slug: str, payload: SetBookmark, ctx: AppContext = Depends(get_ctx)):
     # validate branch
-    if not await db.branches.find_one({"slug": slug}):
-        raise HTTPException(status_code=404, detail="Unknown branch slug")
-    await ensure_client_state(client_id)
-    update = {
-        "$set": {f"bookmarks.{slug}": payload.bookmarked, "updated_at": datetime.utcnow()},
-    }
-    await db.client_states.update_one({"client_id": client_id}, update, upsert=True)
+    ctx.require_branch(slug)
+    await ctx.update_client_state(client_id, {f"bookmarks.{slug}": payload.bookmarked})
     return {"slug": slug, "bookmarked": payload.bookmarked}
 
 class TasksPayload(BaseModel):
     tasks: List[TaskItem]
 
 @api_router.get("/state/{client_id}/tasks/{slug}", response_model=List[TaskItem])
-async def get_tasks(client_id: str, slug: str):
-    await ensure_client_state(client_id)
-    st = await db.client_states.find_one({"client_id": client_id}, {"_id": 0, f"tasks.{slug}": 1})
-    tasks = (st or {}).get("tasks", {}).get(slug)
+async def get_tasks(client_id: str, slug: str, ctx: AppContext = Depends(get_ctx)):
+    state = await ctx.ensure_client_state(client_id)
+    tasks = state.tasks.get(slug)
     if tasks is None:
         # default to branch schedule
-        br = await db.branches.find_one({"slug": slug}, {"_id": 0, "schedule": 1})
-        if not br:
-            raise HTTPException(status_code=404, detail="Unknown branch slug")
-        return [TaskItem(**t) for t in br.get("schedule", [])]
-    return [TaskItem(**t) for t in tasks]
+        return ctx.require_branch(slug).schedule
+    return tasks
 
 @api_router.put("/state/{client_id}/tasks/{slug}")
-async def put_tasks(client_id: str, slug: str, body: TasksPayload):
-    if not await db.branches.find_one({"slug": slug}):
-        raise HTTPException(status_code=404, detail="Unknown branch slug")
-    await ensure_client_state(client_id)
-    update = {
-        "$set": {f"tasks.{slug}": [t.model_dump() for t in body.tasks], "updated_at": datetime.utcnow()}
-    }
-    await db.client_states.update_one({"client_id": client_id}, update, upsert=True)
+async def put_tasks(client_id: str, slug: str, body: TasksPayload, ctx: AppContext = Depends(get_ctx)):
+    ctx.require_branch(slug)
+    await ctx.update_client_state(client_id, {f"tasks.{slug}": [t.model_dump() for t in body.tasks]})
     return {"ok": True}
 
 class QuizBestPayload(BaseModel):
     best: int
 
 @api_router.get("/state/{client_id}/quiz")
-async def get_quiz_progress(client_id: str):
-    await ensure_client_state(client_id)
-    st = await db.client_states.find_one({"client_id": client_id}, {"_id": 0, "quiz": 1})
-    return (st or {}).get("quiz", {})
+async def get_quiz_progress(client_id: str, ctx: AppContext = Depends(get_ctx)):
+    state = await ctx.ensure_client_state(client_id)
+    return state.quiz
 
 @api_router.put("/state/{client_id}/quiz/{slug}")
-async def set_quiz_best(client_id: str, slug: str, body: QuizBestPayload):
-    if not await db.branches.find_one({"slug": slug}):
-        raise HTTPException(status_code=404, detail="Unknown branch slug")
-    await ensure_client_state(client_id)
-    update = {
-        "$set": {f"quiz.{slug}.best": int(body.best), "updated_at": datetime.utcnow()},
-    }
-    await db.client_states.update_one({"client_id": client_id}, update, upsert=True)
+async def set_quiz_best(client_id: str, slug: str, body: QuizBestPayload, ctx: AppContext = Depends(get_ctx)):
+    ctx.require_branch(slug)
+    await ctx.update_client_state(client_id, {f"quiz.{slug}.best": int(body.best)})
     return {"slug": slug, "best": int(body.best)}
 
 class NotesPayload(BaseModel):
     notes: str
 
 @api_router.get("/state/{client_id}/notes")
-async def get_notes(client_id: str):
-    await ensure_client_state(client_id)
-    st = await db.client_states.find_one({"client_id": client_id}, {"_id": 0, "notes": 1})
-    return {"notes": (st or {}).get("notes", "")}
+async def get_notes(client_id: str, ctx: AppContext = Depends(get_ctx)):
+    state = await ctx.ensure_client_state(client_id)
+    return {"notes": state.notes}
 
 @api_router.put("/state/{client_id}/notes")
-async def set_notes(client_id: str, body: NotesPayload):
-    await ensure_client_state(client_id)
-    await db.client_states.update_one({"client_id": client_id}, {"$set": {"notes": body.notes, "updated_at": datetime.utcnow()}}, upsert=True)
+async def set_notes(client_id: str, body: NotesPayload, ctx: AppContext = Depends(get_ctx)):
+    await ctx.update_client_state(client_id, {"notes": body.notes})
     return {"ok": True}
 
-# Include the router in the main app
-app.include_router(api_router)
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
-
-@app.on_event("startup")
-async def on_startup():
-    await seed_branches()
+# Admin: bulk export / import
+@admin_router.get("/export/{collection}")
+async def export_data(collection: str, gzip: bool = False, ctx: AppContext = Depends(get_ctx)):
+    try:
+        check_collection(collection)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    ext = "jsonl.gz" if gzip else "ndjson"
+    return StreamingResponse(
+        export_collection(ctx.db, collection, compress=gzip),
+        media_type="application/gzip" if gzip else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{collection}.{ext}"'},
+    )
+
+@admin_router.post("/import/{collection}")
+async def import_data(collection: str, request: Request, offset: int = 0, gzip: bool = False, ctx: AppContext = Depends(get_ctx)):
+    try:
+        check_collection(collection)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    compressed = gzip or request.headers.get("content-encoding") == "gzip"
+    try:
+        return await import_collection(ctx.db, collection, iter_lines(request.stream(), compressed), offset=offset)
+    except TransferError as e:
+        raise HTTPException(status_code=422, detail={"error": str(e), "next_offset": e.next_offset})
+    finally:
+        if collection == "client_states":
+            # any cached state may have been replaced, even by a partial import
+            await ctx.flush_states()
+
+# Admin: catalog
+@admin_router.post("/catalog/reload")
+async def admin_reload_catalog(ctx: AppContext = Depends(get_ctx)):
+    try:
+        return await ctx.reload_catalog()
+    except (ValueError, KeyError, TypeError) as e:
+        # malformed file (bad JSON, missing key, duplicate slug, invalid
+        # branch); the current snapshot stays in place
+        raise HTTPException(status_code=422, detail=f"Invalid catalog file: {type(e).__name__}: {e}")
+
+@admin_router.get("/catalog")
+async def admin_catalog_info(ctx: AppContext = Depends(get_ctx)):
+    cat = ctx.current_catalog()
+    return {"version": cat.version, "hash": cat.hash, "branches": cat.hashes}
+
+# Admin: metrics
+@admin_router.get("/metrics/mongo")
+async def admin_mongo_metrics():
+    return {"pool": pool_metrics.snapshot()}
+
+@admin_router.get("/metrics/limits")
+async def admin_limit_metrics(request: Request):
+    return request.app.state.limits.stats()
+
+# Admin: profiling
+@admin_router.post("/profile", response_class=PlainTextResponse)
+async def admin_profile(
+    seconds: float = Query(10, gt=0, le=60),
+    interval_ms: float = Query(5, ge=1, le=1000),
+    all_threads: bool = False,
+    ctx: AppContext = Depends(get_ctx),
+):
+    """Sample stacks for ``seconds`` and return them in collapsed (flamegraph) format.
+
+    By default only the event loop thread is sampled; ``all_threads`` adds the
+    executor threads Motor runs its I/O on.
+    """
+    threads = None if all_threads else [ctx.loop_thread_id]
+    try:
+        return await asyncio.to_thread(sample_stacks, seconds, interval_ms / 1000, threads)
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@admin_router.get("/profile/slow")
+async def admin_slow_requests(ctx: AppContext = Depends(get_ctx)):
+    return ctx.slow_requests.recent()
+
+@admin_router.get("/profile/loop")
+async def admin_loop_lag(ctx: AppContext = Depends(get_ctx)):
+    return ctx.loop_lag.stats()
+
+# Admin: caches
+@admin_router.get("/cache")
+async def admin_cache_info(ctx: AppContext = Depends(get_ctx)):
+    return {
+        "invalidation": ctx.bus.mode,
+        "origin": ctx.bus.origin,
+        "state_cache": cache_stats(ctx.state_cache),
+        "catalog_version": ctx.current_catalog().version,
+    }
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+# ------------------------
+# APP LIFECYCLE
+# ------------------------
+async def _timed(timings: Dict[str, float], name: str, coro):
+    start = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        timings[name] = (time.perf_counter() - start) * 1000
+
+async def warm_up(ctx: AppContext, initial: Catalog):
+    """Create indexes and sync the catalog concurrently, after serving has started,
+    then run the one-time status check migration.
+
+    Retries with backoff so a pod started before Mongo is reachable becomes
+    ready once it is.
+    """
+    timings: Dict[str, float] = {}
+    start = time.perf_counter()
+
+    async def attempt():
+        nonlocal start
+        # report the successful attempt only
+        timings.clear()
+        start = time.perf_counter()
+        await asyncio.gather(
+            _timed(timings, "lifecycle_indexes", ensure_lifecycle_indexes(ctx.db)),
+            _timed(timings, "catalog_indexes", ensure_catalog_indexes(ctx.db)),
+            _timed(timings, "status_indexes", ensure_status_indexes(ctx.db)),
+        )
+        await _timed(timings, "catalog_sync", ctx.install_catalog(initial))
+
+    await retry_with_backoff(attempt, "Warm-up", retry_on=(PyMongoError,))
+    try:
+        await _timed(timings, "status_migration", migrate_legacy_checks(ctx.db))
+    except Exception:
+        # must not keep the pod unready; it runs again on the next start
+        logger.exception("Migrating legacy status checks failed")
+    logger.info(
+        "Warm-up finished in %.1fms (%s)",
+        (time.perf_counter() - start) * 1000,
+        ", ".join(f"{k} {v:.1f}ms" for k, v in timings.items()),
+    )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    ctx: AppContext = app.state.ctx
+    timings: Dict[str, float] = {}
+    start = time.perf_counter()
+    ctx.loop_thread_id = threading.get_ident()
+    ctx.loop_lag.start()
+    ctx.slow_requests.start(ctx.loop_thread_id)
+
+    # motor connects on first operation, so this does no I/O
+    if ctx.database is not None:
+        ctx.db = ctx.catalog_db = ctx.database
+    else:
+        ctx.db, ctx.catalog_db = get_db(), get_catalog_db()
+    # the catalog file is local: serve from it immediately, sync it in warm-up
+    ctx.catalog = await _timed(timings, "catalog_load", asyncio.to_thread(read_catalog_file))
+    ctx.bus = create_bus(ctx.db)
+    ctx.bus.subscribe(ctx.on_invalidation)
+    await ctx.bus.start()
+    ctx.warmup_task = asyncio.create_task(warm_up(ctx, ctx.catalog))
+    if ARCHIVE_INTERVAL_SECONDS > 0:
+        ctx.archiver_task = asyncio.create_task(run_archiver(ctx.db))
+    logger.info(
+        "Startup finished in %.1fms (%s); warm-up continues in background",
+        (time.perf_counter() - start) * 1000,
+        ", ".join(f"{k} {v:.1f}ms" for k, v in timings.items()),
+    )
+    try:
+        yield
+    finally:
+        for task in (ctx.warmup_task, ctx.archiver_task):
+            if task:
+                task.cancel()
+        ctx.loop_lag.stop()
+        ctx.slow_requests.stop()
+        await ctx.bus.stop()
+        if ctx.database is None:
+            close_client()
+
+async def database_error_handler(request: Request, exc: PyMongoError):
+    if exc.timeout:
+        return JSONResponse(status_code=503, content={"detail": "Database timeout"}, headers={"Retry-After": "1"})
+    logger.exception("Database error on %s %s", request.method, request.url.path)
+    return JSONResponse(status_code=500, content={"detail": "Database error"})
+
+def create_app(database=None) -> FastAPI:
+    """Build the application; ``database`` overrides the Mongo database (tests)."""
+    app = FastAPI(lifespan=lifespan)
+    app.state.ctx = AppContext(database)
+    app.state.limits = Limits()
+    app.add_exception_handler(PyMongoError, database_error_handler)
+    app.include_router(api_router)
+    app.include_router(admin_router)
+    # innermost: times only requests that got past the limiter
+    app.add_middleware(SlowRequestMiddleware, log=app.state.ctx.slow_requests)
+    # added before CORS so CORS wraps it and 429/503 responses stay readable
+    app.add_middleware(RateLimitMiddleware, limits=app.state.limits)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_credentials=True,
+        allow_origins=["*"],
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    return app
+
+app = create_app()
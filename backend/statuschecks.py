@@ -0,0 +1,175 @@
+"""Bucketed storage for status checks.
+
+Instead of one document per ping, checks are folded into one document per
+``client_name`` and time window in ``status_buckets``:
+
+    { client_name, start, count, first, last, samples: [{ id, timestamp }] }
+
+``count`` is exact; ``samples`` keeps only the latest STATUS_BUCKET_SAMPLES
+pings of the window. Buckets expire through a TTL index on ``start`` after
+STATUS_RETENTION_DAYS, so storage and query cost follow the requested time
+range rather than the total number of pings ever recorded.
+
+Documents in the legacy one-per-ping ``status_checks`` collection are folded
+into buckets once by ``migrate_legacy_checks`` and expire through a TTL
+index on ``timestamp`` like the buckets do.
+"""
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from database import ensure_ttl_index
+
+BUCKET_COLLECTION = "status_buckets"
+LEGACY_COLLECTION = "status_checks"
+MIGRATION_ID = "status_checks_to_buckets"
+BUCKET_SECONDS = int(os.environ.get("STATUS_BUCKET_SECONDS", "3600"))
+BUCKET_SAMPLES = int(os.environ.get("STATUS_BUCKET_SAMPLES", "100"))
+RETENTION_DAYS = int(os.environ.get("STATUS_RETENTION_DAYS", "30"))
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def bucket_start(ts: datetime, seconds: int = BUCKET_SECONDS) -> datetime:
+    offset = int((ts - EPOCH).total_seconds()) // seconds * seconds
+    return EPOCH + timedelta(seconds=offset)
+
+
+async def ensure_status_indexes(db):
+    await db[BUCKET_COLLECTION].create_index([("client_name", 1), ("start", 1)], unique=True)
+    await ensure_ttl_index(db[BUCKET_COLLECTION], "start", RETENTION_DAYS * 86400)
+    await ensure_ttl_index(db[LEGACY_COLLECTION], "timestamp", RETENTION_DAYS * 86400)
+
+
+async def migrate_legacy_checks(db) -> bool:
+    """Fold legacy ``status_checks`` documents into buckets, once.
+
+    Runs after ``ensure_status_indexes`` ($merge needs the unique bucket
+    index). Merged buckets are flagged ``legacy_migrated`` and left alone by a
+    rerun, so an interrupted migration can simply run again. Returns whether
+    it ran.
+    """
+    if await db.migrations.find_one({"_id": MIGRATION_ID}):
+        return False
+    bucket_ms = BUCKET_SECONDS * 1000
+    pipeline = [
+        # anything older would be expired by the TTL index anyway
+        {"$match": {"timestamp": {"$gte": datetime.utcnow() - timedelta(days=RETENTION_DAYS)}}},
+        {"$sort": {"timestamp": 1}},
+        {
+            "$group": {
+                "_id": {
+                    "client_name": "$client_name",
+                    "start": {"$subtract": ["$timestamp", {"$mod": [{"$toLong": "$timestamp"}, bucket_ms]}]},
+                },
+                "count": {"$sum": 1},
+                "first": {"$min": "$timestamp"},
+                "last": {"$max": "$timestamp"},
+                "samples": {"$push": {"id": "$id", "timestamp": "$timestamp"}},
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "client_name": "$_id.client_name",
+                "start": "$_id.start",
+                "count": 1,
+                "first": 1,
+                "last": 1,
+                "samples": {"$slice": ["$samples", -BUCKET_SAMPLES]},
+                "legacy_migrated": {"$literal": True},
+            }
+        },
+        {
+            "$merge": {
+                "into": BUCKET_COLLECTION,
+                "on": ["client_name", "start"],
+                # a bucket already written by record_check: add the legacy
+                # pings (they are older, so their samples go first)
+                "whenMatched": [
+                    {
+                        "$set": {
+                            "count": {"$cond": ["$legacy_migrated", "$count", {"$add": ["$count", "$$new.count"]}]},
+                            "first": {"$cond": ["$legacy_migrated", "$first", {"$min": ["$first", "$$new.first"]}]},
+                            "last": {"$cond": ["$legacy_migrated", "$last", {"$max": ["$last", "$$new.last"]}]},
+                            "samples": {
+                                "$cond": [
+                                    "$legacy_migrated",
+                                    "$samples",
+                                    {"$slice": [{"$concatArrays": ["$$new.samples", "$samples"]}, -BUCKET_SAMPLES]},
+                                ]
+                            },
+                            "legacy_migrated": True,
+                        }
+                    }
+                ],
+                "whenNotMatched": "insert",
+            }
+        },
+    ]
+    await db[LEGACY_COLLECTION].aggregate(pipeline, allowDiskUse=True).to_list(None)
+    await db.migrations.update_one({"_id": MIGRATION_ID}, {"$set": {"done_at": datetime.utcnow()}}, upsert=True)
+    return True
+
+
+async def record_check(db, check: Dict[str, Any]):
+    """Add one check (``id``, ``client_name``, ``timestamp``) to its bucket."""
+    ts = check["timestamp"]
+    await db[BUCKET_COLLECTION].update_one(
+        {"client_name": check["client_name"], "start": bucket_start(ts)},
+        {
+            "$inc": {"count": 1},
+            "$min": {"first": ts},
+            "$max": {"last": ts},
+            "$push": {"samples": {"$each": [{"id": check["id"], "timestamp": ts}], "$slice": -BUCKET_SAMPLES}},
+        },
+        upsert=True,
+    )
+
+
+async def recent_checks(db, limit: int = 1000, since: Optional[datetime] = None) -> List[Dict[str, Any]]:
+    """Latest sampled checks (newest buckets first), returned oldest first."""
+    query: Dict[str, Any] = {}
+    if since is not None:
+        query["start"] = {"$gte": bucket_start(since)}
+    cursor = db[BUCKET_COLLECTION].find(query, {"_id": 0}).sort("start", -1)
+    checks: List[Dict[str, Any]] = []
+    oldest_needed: Optional[datetime] = None
+    async for bucket in cursor:
+        # buckets are sorted by start only; once we have enough checks, any
+        # bucket starting before the oldest kept check cannot contribute
+        if oldest_needed is not None and bucket["start"] + timedelta(seconds=BUCKET_SECONDS) <= oldest_needed:
+            break
+        checks.extend({"client_name": bucket["client_name"], **s} for s in bucket.get("samples", []))
+        if len(checks) >= limit:
+            checks.sort(key=lambda c: c["timestamp"], reverse=True)
+            del checks[limit:]
+            oldest_needed = checks[-1]["timestamp"]
+    if since is not None:
+        checks = [c for c in checks if c["timestamp"] >= since]
+    checks.sort(key=lambda c: c["timestamp"])
+    return checks[-limit:]
+
+
+async def summarize(db, since: datetime, until: datetime, interval: int) -> List[Dict[str, Any]]:
+    """Check counts per client_name per ``interval`` seconds over [since, until).
+
+    ``interval`` is rounded up to a whole number of buckets.
+    """
+    interval = max(1, -(-interval // BUCKET_SECONDS)) * BUCKET_SECONDS
+    interval_ms = interval * 1000
+    pipeline = [
+        {"$match": {"start": {"$gte": bucket_start(since), "$lt": until}}},
+        {
+            "$group": {
+                "_id": {
+                    "client_name": "$client_name",
+                    "start": {"$subtract": ["$start", {"$mod": [{"$toLong": "$start"}, interval_ms]}]},
+                },
+                "count": {"$sum": "$count"},
+            }
+        },
+        {"$sort": {"_id.start": 1, "_id.client_name": 1}},
+        {"$project": {"_id": 0, "client_name": "$_id.client_name", "start": "$_id.start", "count": 1}},
+    ]
+    return await db[BUCKET_COLLECTION].aggregate(pipeline).to_list(None)
@@ -0,0 +1,266 @@
+"""Streaming bulk export/import of collections as NDJSON (optionally gzipped).
+
+Export reads from a Motor cursor in batches and yields encoded chunks, so
+memory stays constant regardless of collection size. Import consumes lines as
+they arrive and writes them with ordered ``bulk_write`` upserts keyed on each
+collection's natural key; ``offset`` skips lines already applied so an
+interrupted import can be resumed from the ``next_offset`` it reported.
+
+Also usable from the command line (reads MONGO_URL / DB_NAME like the server):
+
+    python transfer.py export client_states -o client_states.jsonl.gz
+    python transfer.py import client_states -i client_states.jsonl.gz --offset 20000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import zlib
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional
+
+from bson import json_util
+from bson.errors import BSONError
+from bson.json_util import RELAXED_JSON_OPTIONS
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+# collection -> fields identifying a document for upserts
+TRANSFER_COLLECTIONS: Dict[str, List[str]] = {
+    "client_states": ["client_id"],
+    "client_states_archive": ["client_id"],
+    "status_buckets": ["client_name", "start"],
+    # legacy one-document-per-ping layout
+    "status_checks": ["id"],
+}
+
+DEFAULT_BATCH_SIZE = int(os.environ.get("TRANSFER_BATCH_SIZE", "1000"))
+# gzip output is flushed once this many compressed bytes are buffered
+CHUNK_SIZE = 64 * 1024
+
+
+class TransferError(Exception):
+    """An import stopped part-way; ``next_offset`` is where to resume."""
+
+    def __init__(self, message: str, next_offset: int):
+        super().__init__(message)
+        self.next_offset = next_offset
+
+
+def check_collection(name: str) -> List[str]:
+    if name not in TRANSFER_COLLECTIONS:
+        raise ValueError(f"Unsupported collection: {name}")
+    return TRANSFER_COLLECTIONS[name]
+
+
+def encode_doc(doc: Dict[str, Any]) -> bytes:
+    doc = {k: v for k, v in doc.items() if k != "_id"}
+    return json_util.dumps(doc, json_options=RELAXED_JSON_OPTIONS).encode() + b"\n"
+
+
+def decode_line(line: bytes) -> Dict[str, Any]:
+    return json_util.loads(line)
+
+
+def check_doc(doc: Any, keys: List[str]) -> Optional[str]:
+    """Why ``doc`` cannot be imported, or None if it can."""
+    if not isinstance(doc, dict):
+        return "Expected a JSON object"
+    missing = [k for k in keys if doc.get(k) is None]
+    if missing:
+        return f"Missing key field {', '.join(missing)}"
+    return None
+
+
+async def export_collection(db, name: str, compress: bool = False, batch_size: int = DEFAULT_BATCH_SIZE) -> AsyncIterator[bytes]:
+    """Yield the collection as NDJSON chunks, gzip-compressed if ``compress``."""
+    check_collection(name)
+    cursor = db[name].find({}, {"_id": 0}, batch_size=batch_size).sort("_id", 1)
+    gz = zlib.compressobj(wbits=31) if compress else None
+    buf: List[bytes] = []
+    size = 0
+    async for doc in cursor:
+        line = encode_doc(doc)
+        if gz:
+            line = gz.compress(line)
+            if not line:
+                continue
+        buf.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE or (not gz and len(buf) >= batch_size):
+            yield b"".join(buf)
+            buf, size = [], 0
+    if gz:
+        buf.append(gz.flush())
+    if buf:
+        yield b"".join(buf)
+
+
+async def iter_lines(chunks: AsyncIterator[bytes], compressed: bool = False) -> AsyncIterator[bytes]:
+    """Split a byte stream into lines, transparently gunzipping it if ``compressed``.
+
+    A corrupt gzip stream raises TransferError with the number of lines
+    yielded so far as ``next_offset``.
+    """
+    dec = zlib.decompressobj(wbits=47) if compressed else None
+    pending = b""
+    count = 0
+    try:
+        async for chunk in chunks:
+            if dec:
+                chunk = dec.decompress(chunk)
+            pending += chunk
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                count += 1
+                yield line
+        if dec:
+            pending += dec.flush()
+    except zlib.error as exc:
+        raise TransferError(f"Invalid gzip data after line {count}: {exc}", count)
+    if pending:
+        yield pending
+
+
+async def import_collection(
+    db,
+    name: str,
+    lines: AsyncIterator[bytes],
+    offset: int = 0,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> Dict[str, int]:
+    """Upsert NDJSON ``lines`` into ``name``, skipping the first ``offset`` lines.
+
+    Blank lines count towards the offset so it always matches line numbers in
+    the source file.
+    """
+    keys = check_collection(name)
+    position = 0
+    written = 0
+    ops: List[ReplaceOne] = []
+    op_lines: List[int] = []
+
+    async def flush():
+        nonlocal written
+        try:
+            await db[name].bulk_write(ops, ordered=True)
+        except BulkWriteError as exc:
+            # ordered writes stop at the first error; resume just before it
+            failed = exc.details["writeErrors"][0]["index"]
+            written += failed
+            raise TransferError(f"Import into {name} failed on line {op_lines[failed]}: {exc.details['writeErrors'][0].get('errmsg')}", op_lines[failed] - 1)
+        except PyMongoError as exc:
+            # unknown how much of the batch was applied; the upserts are
+            # idempotent, so resume from the start of the batch
+            raise TransferError(f"Import into {name} failed after line {op_lines[0] - 1}: {exc}", op_lines[0] - 1)
+        written += len(ops)
+        ops.clear()
+        op_lines.clear()
+
+    source = lines.__aiter__()
+    while True:
+        try:
+            line = await source.__anext__()
+        except StopAsyncIteration:
+            break
+        except TransferError:
+            # the source failed (corrupt gzip); keep what was read before it
+            if ops:
+                await flush()
+            raise
+        position += 1
+        if position <= offset:
+            continue
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            doc = decode_line(line)
+            error = check_doc(doc, keys)
+        except (ValueError, BSONError) as exc:
+            error = f"Invalid JSON ({exc})"
+        if error:
+            if ops:
+                await flush()
+            raise TransferError(f"{error} on line {position}", position - 1)
+        doc.pop("_id", None)
+        ops.append(ReplaceOne({k: doc.get(k) for k in keys}, doc, upsert=True))
+        op_lines.append(position)
+        if len(ops) >= batch_size:
+            await flush()
+    if ops:
+        await flush()
+    return {"imported": written, "next_offset": max(position, offset)}
+
+
+# ------------------------
+# CLI
+# ------------------------
+async def _file_chunks(f) -> AsyncIterator[bytes]:
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def _run_export(db, name: str, path: Optional[str], compress: bool, batch_size: int):
+    out = open(path, "wb") if path else sys.stdout.buffer
+    try:
+        async for chunk in export_collection(db, name, compress=compress, batch_size=batch_size):
+            out.write(chunk)
+    finally:
+        if path:
+            out.close()
+
+
+async def _run_import(db, name: str, path: Optional[str], compressed: bool, offset: int, batch_size: int):
+    src = open(path, "rb") if path else sys.stdin.buffer
+    try:
+        return await import_collection(db, name, iter_lines(_file_chunks(src), compressed), offset, batch_size)
+    finally:
+        if path:
+            src.close()
+
+
+def main(argv: Optional[Iterable[str]] = None):
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description="Export or import collections as NDJSON")
+    sub = parser.add_subparsers(dest="command", required=True)
+    exp = sub.add_parser("export")
+    exp.add_argument("collection", choices=sorted(TRANSFER_COLLECTIONS))
+    exp.add_argument("-o", "--output", help="output file (stdout if omitted); .gz enables compression")
+    exp.add_argument("--gzip", action="store_true", help="compress output")
+    imp = sub.add_parser("import")
+    imp.add_argument("collection", choices=sorted(TRANSFER_COLLECTIONS))
+    imp.add_argument("-i", "--input", help="input file (stdin if omitted); .gz enables decompression")
+    imp.add_argument("--gzip", action="store_true", help="input is gzip-compressed")
+    imp.add_argument("--offset", type=int, default=0, help="number of lines to skip (resume point)")
+    for p in (exp, imp):
+        p.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    load_dotenv(Path(__file__).parent / ".env")
+    from database import close_client, get_db
+
+    db = get_db()
+    try:
+        if args.command == "export":
+            compress = args.gzip or (args.output or "").endswith(".gz")
+            asyncio.run(_run_export(db, args.collection, args.output, compress, args.batch_size))
+        else:
+            compressed = args.gzip or (args.input or "").endswith(".gz")
+            try:
+                result = asyncio.run(_run_import(db, args.collection, args.input, compressed, args.offset, args.batch_size))
+            except TransferError as exc:
+                print(f"{exc} (resume with --offset {exc.next_offset})", file=sys.stderr)
+                return 1
+            print(f"Imported {result['imported']} documents; next offset {result['next_offset']}", file=sys.stderr)
+    finally:
+        close_client()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,8 +6,11 @@ Tests all FastAPI endpoints via Kubernetes ingress routing
 
 import requests
 import json
+import os
 import uuid
 import sys
+import threading
+import time
 from typing import Dict, Any, List
 
 # Backend URL from environment
@@ -36,16 +39,18 @@ class BackendTester:
         if not success:
             self.failed_tests.append(test_name)
     
-    def make_request(self, method: str, endpoint: str, data: Dict = None) -> tuple:
+    def make_request(self, method: str, endpoint: str, data: Dict = None, headers: Dict = None, content: bytes = None) -> tuple:
         """Make HTTP request and return (success, response, error)"""
         url = f"{self.base_url}{endpoint}"
         try:
             if method.upper() == "GET":
-                response = requests.get(url, timeout=10)
+                response = requests.get(url, headers=headers, timeout=10)
             elif method.upper() == "PUT":
-                response = requests.put(url, json=data, timeout=10)
+                response = requests.put(url, json=data, headers=headers, timeout=10)
+            elif method.upper() == "POST" and content is not None:
+                response = requests.post(url, data=content, headers=headers, timeout=10)
             elif method.upper() == "POST":
-                response = requests.post(url, json=data, timeout=10)
+                response = requests.post(url, json=data, headers=headers, timeout=10)
             else:
                 return False, None, f"Unsupported method: {method}"
             
@@ -399,6 +404,266 @@ class BackendTester:
         
         self.log_test("Error Handling", True, "All error cases return proper 404 responses")
     
+    def test_health_probes(self):
+        """Test 10: Liveness and readiness probes"""
+        for name, endpoint in (("Liveness", "/health/live"), ("Readiness", "/health/ready")):
+            success, response, error = self.make_request("GET", endpoint)
+            
+            if not success:
+                self.log_test(f"Health Probes - {name}", False, f"Request failed: {error}")
+                return
+            
+            if response.status_code != 200:
+                self.log_test(f"Health Probes - {name}", False, f"Status {response.status_code}: {response.text}")
+                return
+        
+        self.log_test("Health Probes", True, "Liveness and readiness both return 200")
+    
+    def test_status_summary(self):
+        """Test 11: Status checks are counted in the summary"""
+        client_name = f"tester-{self.client_id[:8]}"
+        success, response, error = self.make_request("POST", "/status", {"client_name": client_name})
+        
+        if not success:
+            self.log_test("Status Summary - Create", False, f"Request failed: {error}")
+            return
+        
+        if response.status_code != 200:
+            self.log_test("Status Summary - Create", False, f"Status {response.status_code}: {response.text}")
+            return
+        
+        success, response, error = self.make_request("GET", "/status/summary")
+        
+        if not success:
+            self.log_test("Status Summary - Get", False, f"Request failed: {error}")
+            return
+        
+        try:
+            rows = response.json()
+            count = sum(r.get("count", 0) for r in rows if r.get("client_name") == client_name)
+            
+            if count != 1:
+                self.log_test("Status Summary", False, f"Expected count 1 for {client_name}, got {count}")
+                return
+            
+            self.log_test("Status Summary", True, "Status check counted in summary")
+            
+        except Exception as e:
+            self.log_test("Status Summary", False, f"JSON parse error: {e}")
+    
+    def test_export_import_roundtrip(self):
+        """Test 12: Client state survives an admin export and re-import"""
+        token = os.environ.get("ADMIN_TOKEN")
+        if not token:
+            print("⏭️  SKIP: Export/Import Roundtrip (ADMIN_TOKEN not set)")
+            return
+        headers = {"X-Admin-Token": token}
+        
+        success, response, error = self.make_request("PUT", f"/state/{self.client_id}/notes", {"notes": "before export"})
+        if not success or response.status_code != 200:
+            self.log_test("Export/Import - Setup", False, f"Could not set notes: {error or response.text}")
+            return
+        
+        success, response, error = self.make_request("GET", "/admin/export/client_states", headers=headers)
+        if not success:
+            self.log_test("Export/Import - Export", False, f"Request failed: {error}")
+            return
+        
+        if response.status_code != 200:
+            self.log_test("Export/Import - Export", False, f"Status {response.status_code}: {response.text}")
+            return
+        
+        docs = [json.loads(line) for line in response.text.splitlines() if line.strip()]
+        mine = [d for d in docs if d.get("client_id") == self.client_id]
+        if len(mine) != 1 or mine[0].get("notes") != "before export":
+            self.log_test("Export/Import - Export", False, f"Expected one exported state with notes, got {mine}")
+            return
+        
+        mine[0]["notes"] = "after import"
+        body = (json.dumps(mine[0]) + "\n[1, 2]\n").encode()
+        success, response, error = self.make_request("POST", "/admin/import/client_states", headers=headers, content=body)
+        if not success:
+            self.log_test("Export/Import - Import", False, f"Request failed: {error}")
+            return
+        
+        # the first line is applied; the second is not an object and is reported with its resume offset
+        detail = response.json().get("detail", {}) if response.status_code == 422 else {}
+        if detail.get("next_offset") != 1:
+            self.log_test("Export/Import - Import", False, f"Expected 422 with next_offset 1, got {response.status_code}: {response.text}")
+            return
+        
+        success, response, error = self.make_request("GET", "/admin/export/client_states", headers=headers)
+        if not success or response.status_code != 200:
+            self.log_test("Export/Import - Re-export", False, f"Request failed: {error or response.text}")
+            return
+        
+        docs = [json.loads(line) for line in response.text.splitlines() if line.strip()]
+        mine = [d for d in docs if d.get("client_id") == self.client_id]
+        if len(mine) != 1 or mine[0].get("notes") != "after import":
+            self.log_test("Export/Import Roundtrip", False, f"Imported state not found: {mine}")
+            return
+        
+        # the import must not leave the previously cached state being served
+        success, response, error = self.make_request("GET", f"/state/{self.client_id}/notes")
+        if not success or response.status_code != 200 or response.json().get("notes") != "after import":
+            self.log_test("Export/Import Roundtrip", False, f"Stale state served after import: {error or response.text}")
+            return
+        
+        self.log_test("Export/Import Roundtrip", True, "State exported, re-imported and invalid line reported")
+    
+    def test_rate_limit(self):
+        """Test 13: Rapid writes for one client are rejected with 429 and Retry-After"""
+        client_id = str(uuid.uuid4())
+        rejected = None
+        
+        # the per-client bucket allows a burst of 20 by default; stop at the first rejection
+        for i in range(200):
+            success, response, error = self.make_request("PUT", f"/state/{client_id}/notes", {"notes": f"note {i}"})
+            if not success:
+                self.log_test("Rate Limit", False, f"Request failed: {error}")
+                return
+            if response.status_code == 429:
+                rejected = response
+                break
+            if response.status_code != 200:
+                self.log_test("Rate Limit", False, f"Status {response.status_code}: {response.text}")
+                return
+        
+        if rejected is None:
+            self.log_test("Rate Limit", False, "No 429 after 200 rapid writes")
+            return
+        
+        retry_after = rejected.headers.get("Retry-After", "")
+        if not retry_after.isdigit() or int(retry_after) < 1:
+            self.log_test("Rate Limit", False, f"Missing or invalid Retry-After header: {retry_after!r}")
+            return
+        
+        self.log_test("Rate Limit", True, f"429 after {i} writes, Retry-After {retry_after}s")
+    
+    def test_state_lifecycle(self):
+        """Test 14: States carry last_seen, and the first write clears pristine"""
+        client_id = str(uuid.uuid4())
+        success, response, error = self.make_request("GET", f"/state/{client_id}")
+        
+        if not success:
+            self.log_test("State Lifecycle - Bootstrap", False, f"Request failed: {error}")
+            return
+        
+        if response.status_code != 200 or not response.json().get("last_seen"):
+            self.log_test("State Lifecycle - Bootstrap", False, f"Expected last_seen in state: {response.text}")
+            return
+        
+        token = os.environ.get("ADMIN_TOKEN")
+        if not token:
+            self.log_test("State Lifecycle", True, "last_seen returned (pristine check skipped, ADMIN_TOKEN not set)")
+            return
+        headers = {"X-Admin-Token": token}
+        
+        def exported_state():
+            success, response, error = self.make_request("GET", "/admin/export/client_states", headers=headers)
+            if not success or response.status_code != 200:
+                return None
+            docs = [json.loads(line) for line in response.text.splitlines() if line.strip()]
+            return next((d for d in docs if d.get("client_id") == client_id), None)
+        
+        doc = exported_state()
+        if not doc or doc.get("pristine") is not True:
+            self.log_test("State Lifecycle - Pristine", False, f"Expected a pristine auto-created state, got {doc}")
+            return
+        
+        success, response, error = self.make_request("PUT", f"/state/{client_id}/notes", {"notes": "touched"})
+        if not success or response.status_code != 200:
+            self.log_test("State Lifecycle - Write", False, f"Request failed: {error or response.text}")
+            return
+        
+        doc = exported_state()
+        if not doc or "pristine" in doc:
+            self.log_test("State Lifecycle", False, f"Expected pristine to be cleared by the write, got {doc}")
+            return
+        
+        self.log_test("State Lifecycle", True, "last_seen returned and pristine cleared on first write")
+    
+    def test_catalog_admin(self):
+        """Test 15: Reloading an unchanged catalog file rewrites nothing"""
+        token = os.environ.get("ADMIN_TOKEN")
+        if not token:
+            print("⏭️  SKIP: Catalog Admin (ADMIN_TOKEN not set)")
+            return
+        headers = {"X-Admin-Token": token}
+        
+        success, response, error = self.make_request("POST", "/admin/catalog/reload", headers=headers)
+        if not success:
+            self.log_test("Catalog Admin - Reload", False, f"Request failed: {error}")
+            return
+        
+        if response.status_code != 200:
+            self.log_test("Catalog Admin - Reload", False, f"Status {response.status_code}: {response.text}")
+            return
+        
+        result = response.json()
+        if result.get("skipped") is not False or result.get("upserted") != []:
+            self.log_test("Catalog Admin - Reload", False, f"Expected an applied reload with no upserts, got {result}")
+            return
+        
+        success, response, error = self.make_request("GET", "/admin/catalog", headers=headers)
+        if not success or response.status_code != 200:
+            self.log_test("Catalog Admin - Info", False, f"Request failed: {error or response.text}")
+            return
+        
+        info = response.json()
+        if info.get("version") != result.get("version") or len(info.get("branches", {})) < 6:
+            self.log_test("Catalog Admin - Info", False, f"Unexpected catalog info: {info}")
+            return
+        
+        self.log_test("Catalog Admin", True, f"Catalog v{info['version']} reloaded without changes")
+    
+    def test_profiling_admin(self):
+        """Test 16: On-demand profile returns collapsed stacks, and only one runs at a time"""
+        token = os.environ.get("ADMIN_TOKEN")
+        if not token:
+            print("⏭️  SKIP: Profiling Admin (ADMIN_TOKEN not set)")
+            return
+        headers = {"X-Admin-Token": token}
+        
+        # start a longer profile in the background; a second one must be refused meanwhile
+        background = {}
+        thread = threading.Thread(
+            target=lambda: background.update(result=self.make_request("POST", "/admin/profile?seconds=3", headers=headers))
+        )
+        thread.start()
+        time.sleep(1)
+        success, busy, error = self.make_request("POST", "/admin/profile?seconds=1", headers=headers)
+        thread.join()
+        
+        if not success:
+            self.log_test("Profiling Admin - Busy", False, f"Request failed: {error}")
+            return
+        
+        if busy.status_code != 409:
+            self.log_test("Profiling Admin - Busy", False, f"Expected 409 while a profile runs, got {busy.status_code}: {busy.text}")
+            return
+        
+        success, response, error = background["result"]
+        if not success or response.status_code != 200:
+            self.log_test("Profiling Admin - Profile", False, f"Request failed: {error or response.text}")
+            return
+        
+        lines = response.text.splitlines()
+        if not lines or not all(line.rsplit(" ", 1)[-1].isdigit() for line in lines):
+            self.log_test("Profiling Admin - Profile", False, f"Expected collapsed stack lines, got: {response.text[:200]}")
+            return
+        
+        success, response, error = self.make_request("GET", "/admin/profile/slow", headers=headers)
+        if not success or response.status_code != 200:
+            self.log_test("Profiling Admin - Slow Requests", False, f"Request failed: {error or response.text}")
+            return
+        
+        if not isinstance(response.json(), list):
+            self.log_test("Profiling Admin - Slow Requests", False, f"Expected a list, got {response.json()}")
+            return
+        
+        self.log_test("Profiling Admin", True, f"{len(lines)} stacks sampled, concurrent profile refused")
+    
     def run_all_tests(self):
         """Run all tests"""
         print(f"🧪 Starting Backend API Tests")
@@ -416,6 +681,13 @@ class BackendTester:
         self.test_quiz_progress()
         self.test_notes_flow()
         self.test_error_handling()
+        self.test_health_probes()
+        self.test_status_summary()
+        self.test_export_import_roundtrip()
+        self.test_rate_limit()
+        self.test_state_lifecycle()
+        self.test_catalog_admin()
+        self.test_profiling_admin()
         
         # Summary
         print("\n" + "=" * 60)